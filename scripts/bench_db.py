@@ -0,0 +1,106 @@
+"""
+Бенчмарк: задержка запросов с новым соединением на каждый вызов
+против пула постоянных соединений Database, и время выделения IP
+по мере заполнения подсети
+
+    python scripts/bench_db.py --users 1000 --queries 5000 --allocations 20000
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from database import Database  # noqa: E402
+
+
+def connect_per_call(db_path, user_id):
+    with sqlite3.connect(db_path) as conn:
+        conn.row_factory = sqlite3.Row
+        conn.execute("SELECT * FROM users WHERE user_id = ?", (user_id,)).fetchone()
+    with sqlite3.connect(db_path) as conn:
+        conn.row_factory = sqlite3.Row
+        conn.execute(
+            "SELECT * FROM vpn_configs WHERE user_id = ? ORDER BY created_at DESC", (user_id,)
+        ).fetchall()
+
+
+def pooled(db, user_id):
+    db.get_user(user_id)
+    db.get_all_vpn_configs(user_id)
+
+
+def measure(fn, target, user_ids):
+    samples = []
+    for user_id in user_ids:
+        started = time.perf_counter()
+        fn(target, user_id)
+        samples.append((time.perf_counter() - started) * 1e6)
+    samples.sort()
+    return {
+        "mean": statistics.mean(samples),
+        "p50": samples[len(samples) // 2],
+        "p99": samples[int(len(samples) * 0.99)],
+    }
+
+
+def bench_allocations(tmp, total, step=5000):
+    db = Database(os.path.join(tmp, "alloc.db"), ip_pools={"default": "10.0.0.0/16"})
+    for start in range(0, total, step):
+        started = time.perf_counter()
+        for i in range(start, start + step):
+            db.create_vpn_config(i, "cfg", "priv", f"pub{i}")
+        elapsed = time.perf_counter() - started
+        print(f"  {start + step:>6} адресов: {elapsed / step * 1e6:.0f}мкс на выделение")
+
+    # Освобождаем каждый второй адрес и выделяем заново из free-list
+    for i in range(0, total, 2):
+        db.delete_vpn_config(i, "cfg")
+    started = time.perf_counter()
+    for i in range(0, total, 2):
+        db.create_vpn_config(i, "again", "priv", f"again{i}")
+    elapsed = time.perf_counter() - started
+    print(f"  повторная выдача: {elapsed / (total // 2) * 1e6:.0f}мкс на выделение")
+    db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--queries", type=int, default=5000)
+    parser.add_argument("--allocations", type=int, default=20000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "bench.db")
+        # Адреса выдаёт аллокатор: пара (server, ip_address) уникальна
+        db = Database(db_path, ip_pools={"default": "10.0.0.0/16"})
+        for user_id in range(args.users):
+            db.add_user(user_id, f"user{user_id}", "bench")
+            for n in range(3):
+                db.create_vpn_config(user_id, f"cfg{n}", "priv", f"pub{user_id}-{n}")
+
+        user_ids = [random.randrange(args.users) for _ in range(args.queries)]
+        for name, fn, target in (
+            ("connect-per-call", connect_per_call, db_path),
+            ("pooled", pooled, db),
+        ):
+            stats = measure(fn, target, user_ids)
+            print(
+                f"{name:>16}: mean {stats['mean']:.0f}мкс, "
+                f"p50 {stats['p50']:.0f}мкс, p99 {stats['p99']:.0f}мкс"
+            )
+        db.close()
+
+        print("Выделение IP в /16:")
+        bench_allocations(tmp, args.allocations)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""
+Бенчмарк генерации ключей: по одной паре, пачкой и из KeyPool
+
+    python scripts/bench_keys.py --keys 2000
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from wireguard import KeyPool, generate_keys, generate_keys_bulk  # noqa: E402
+
+
+def report(name, n, elapsed):
+    print(f"{name:>8}: {n / elapsed:,.0f} ключей/с, {elapsed / n * 1e6:.1f}мкс на пару")
+
+
+async def pooled(n):
+    pool = KeyPool(low_water=n // 4, high_water=n)
+    pool.start()
+    while len(pool) < n:
+        await asyncio.sleep(0.01)
+
+    started = time.perf_counter()
+    for _ in range(n):
+        await pool.get()
+    elapsed = time.perf_counter() - started
+    pool.close()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--keys", type=int, default=2000)
+    args = parser.parse_args()
+    n = args.keys
+
+    started = time.perf_counter()
+    for _ in range(n):
+        generate_keys()
+    report("single", n, time.perf_counter() - started)
+
+    started = time.perf_counter()
+    generate_keys_bulk(n)
+    report("bulk", n, time.perf_counter() - started)
+
+    report("pooled", n, asyncio.run(pooled(n)))
+
+
+if __name__ == "__main__":
+    main()
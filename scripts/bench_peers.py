@@ -0,0 +1,56 @@
+"""
+Бенчмарк: N последовательных add/remove с сохранением после каждого
+против одного батча через PeerQueue
+
+    python scripts/bench_peers.py --peers 200 --latency 0.01
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+sys.path.insert(0, os.path.dirname(__file__))
+
+from fake_awg import install_fake_awg  # noqa: E402
+
+
+async def sequential(server, keys):
+    for i, key in enumerate(keys):
+        await server.run_awg("awg", "set", "wg0", "peer", key, "allowed-ips", f"10.0.{i}.2/32")
+        await server.run_awg("awg-quick", "save", "wg0")
+
+
+async def batched(server, keys):
+    queue = server.PeerQueue(
+        server.LocalAwgBackend(), interface="wg0", window=0.05, max_batch=len(keys)
+    )
+    results = await asyncio.gather(*(queue.add(key, f"10.0.{i}.2") for i, key in enumerate(keys)))
+    assert all(results), "не все пиры добавлены"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--peers", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ.update(install_fake_awg(tmp, os.path.join(tmp, "state.json"), args.latency))
+        import server
+
+        keys = [f"peer{i:06d}" for i in range(args.peers)]
+        for name, bench in (("sequential", sequential), ("batched", batched)):
+            started = time.perf_counter()
+            asyncio.run(bench(server, keys))
+            elapsed = time.perf_counter() - started
+            print(
+                f"{name:>10}: {args.peers} пиров за {elapsed:.3f}с ({args.peers / elapsed:.0f}/с)"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Сверка базы с интерфейсом на фейковом awg
+
+Заполняет базу N пирами, а фейковый интерфейс — теми же пирами с
+расхождениями (часть пиров отсутствует, часть лишних, часть с чужим
+адресом), прогоняет Reconciler и проверяет, что второй проход ничего не
+меняет.
+
+    python scripts/bench_reconcile.py --peers 20000
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+sys.path.insert(0, os.path.dirname(__file__))
+
+from fake_awg import install_fake_awg  # noqa: E402
+
+
+def ip(i):
+    return f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--peers", type=int, default=20000)
+    args = parser.parse_args()
+    n = args.peers
+
+    with tempfile.TemporaryDirectory() as tmp:
+        state_path = os.path.join(tmp, "state.json")
+        os.environ.update(install_fake_awg(tmp, state_path))
+
+        from database import AsyncDatabase, Database
+        from reconcile import Reconciler
+        from server import LocalAwgBackend, Node
+
+        db = Database(os.path.join(tmp, "bot.db"), ip_pools={"bench": "10.0.0.0/8"})
+        with db.get_connection() as conn:
+            conn.executemany(
+                """
+                INSERT INTO vpn_configs
+                    (user_id, name, private_key, public_key, ip_address, server)
+                VALUES (?, 'cfg', 'priv', ?, ?, 'bench')
+            """,
+                ((i, f"peer{i}", ip(i + 2)) for i in range(n)),
+            )
+
+        live = {}
+        for i in range(n):
+            if i % 10 == 0:
+                continue
+            allowed = ip(i + 2) if i % 100 != 1 else "10.255.255.254"
+            live[f"peer{i}"] = {"allowed_ips": f"{allowed}/32", "handshake": 0, "rx": 0, "tx": 0}
+        for i in range(n // 20):
+            live[f"stray{i}"] = {"allowed_ips": "10.254.0.1/32", "handshake": 0, "rx": 0, "tx": 0}
+        with open(state_path, "w") as f:
+            json.dump({"wg0": live}, f)
+
+        node = Node("bench", "1.2.3.4:51820", "SERVERKEY", "10.0.0.0/8", LocalAwgBackend())
+        reconciler = Reconciler(AsyncDatabase(db), [node])
+
+        for attempt in ("первый проход", "повторный проход"):
+            started = time.perf_counter()
+            result = asyncio.run(reconciler.reconcile())["bench"]
+            elapsed = time.perf_counter() - started
+            print(f"{attempt}: {result} за {elapsed:.2f}с")
+
+        with open(state_path) as f:
+            final = json.load(f)["wg0"]
+        assert len(final) == n and not any(key.startswith("stray") for key in final)
+        print("интерфейс совпадает с базой")
+
+
+if __name__ == "__main__":
+    main()
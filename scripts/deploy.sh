@@ -4,26 +4,121 @@ set -e
 
 echo "Деплоим VPN бот..."
 
-echo "Останавливаем бота..."
-pkill -f "python.*src/main.py" || true
+# Значение переменной из .env, иначе значение по умолчанию
+env_value() {
+    local value
+    value=$(grep -E "^$1=" .env 2> /dev/null | tail -n 1 | cut -d= -f2- | tr -d "\"' ")
+    echo "${value:-$2}"
+}
+
+# Порт проб /ready и /health (он же порт метрик) и сколько ждать остановки
+METRICS_HOST=$(env_value METRICS_HOST 127.0.0.1)
+METRICS_PORT=$(env_value METRICS_PORT 9100)
+SHUTDOWN_TIMEOUT=$(env_value SHUTDOWN_TIMEOUT 30)
+if [ "$METRICS_HOST" = "0.0.0.0" ]; then
+    METRICS_HOST=127.0.0.1
+fi
+READY_URL="http://$METRICS_HOST:$METRICS_PORT/ready"
+
+# Порты, которые новый экземпляр займёт при старте
+PORTS=""
+if [ "$METRICS_PORT" != "0" ]; then
+    PORTS="$METRICS_HOST:$METRICS_PORT"
+fi
+if [ "$(env_value BOT_MODE polling)" = "webhook" ]; then
+    WEBHOOK_HOST=$(env_value WEBHOOK_HOST 127.0.0.1)
+    if [ "$WEBHOOK_HOST" = "0.0.0.0" ]; then
+        WEBHOOK_HOST=127.0.0.1
+    fi
+    PORTS="$PORTS $WEBHOOK_HOST:$(env_value WEBHOOK_PORT 8080)"
+fi
+
+# Кто-то ещё слушает один из PORTS
+ports_busy() {
+    local address
+    for address in $PORTS; do
+        if (echo > "/dev/tcp/${address%:*}/${address##*:}") 2> /dev/null; then
+            return 0
+        fi
+    done
+    return 1
+}
+
+# Жив ли хоть один из старых процессов
+old_alive() {
+    local pid
+    for pid in $OLD_PIDS; do
+        kill -0 $pid 2> /dev/null && return 0
+    done
+    return 1
+}
 
 echo "Проверяем uv..."
 if ! command -v uv &> /dev/null; then
     echo "Устанавливаем uv..."
     curl -LsSf https://astral.sh/uv/install.sh | sh
-    export PATH="$HOME/.cargo/bin:$HOME/.local/bin:$PATH"
 fi
+export PATH="$HOME/.cargo/bin:$HOME/.local/bin:$PATH"
 
+# Зависимости ставим, пока старый экземпляр ещё работает
 echo "Обновляем зависимости..."
 uv sync
 
+OLD_PIDS=$(pgrep -f "python.*src/main.py" || true)
+if [ -n "$OLD_PIDS" ]; then
+    # По SIGTERM старый бот перестаёт забирать апдейты и освобождает порты,
+    # а начатые операции доделывает в фоне до SHUTDOWN_TIMEOUT секунд.
+    # Новый запускается, когда порты свободны; без портов — после выхода старого
+    echo "Останавливаем прием апдейтов старым ботом ($OLD_PIDS)..."
+    kill -TERM $OLD_PIDS || true
+    for _ in $(seq 1 $((2 * (SHUTDOWN_TIMEOUT + 5)))); do
+        old_alive || break
+        if [ -n "$PORTS" ] && ! ports_busy; then
+            break
+        fi
+        sleep 0.5
+    done
+    if old_alive && { [ -z "$PORTS" ] || ports_busy; }; then
+        echo "Старый бот не освободил порты, завершаем принудительно"
+        kill -KILL $OLD_PIDS 2> /dev/null || true
+        sleep 1
+    fi
+fi
+
 echo "Запускаем бота..."
-export PATH="$HOME/.cargo/bin:$HOME/.local/bin:$PATH"
-nohup uv run python src/main.py > bot.log 2>&1 &
+nohup uv run python src/main.py >> bot.log 2>&1 &
+NEW_PID=$!
+
+STARTED=0
+if [ "$METRICS_PORT" != "0" ]; then
+    for _ in $(seq 1 60); do
+        if curl -fs "$READY_URL" > /dev/null 2>&1; then
+            STARTED=1
+            break
+        fi
+        kill -0 $NEW_PID 2> /dev/null || break
+        sleep 0.5
+    done
+else
+    sleep 2
+    kill -0 $NEW_PID 2> /dev/null && STARTED=1
+fi
 
-sleep 2
+if [ -n "$OLD_PIDS" ]; then
+    echo "Ждем, пока старый бот доделает начатое..."
+    for _ in $(seq 1 $((SHUTDOWN_TIMEOUT + 5))); do
+        old_alive || break
+        sleep 1
+    done
+    for pid in $OLD_PIDS; do
+        if kill -0 $pid 2> /dev/null; then
+            echo "Старый бот $pid не остановился, завершаем принудительно"
+            kill -KILL $pid || true
+        fi
+    done
+fi
 
-if pgrep -f "python.*src/main.py" > /dev/null; then
+if [ "$STARTED" = "1" ]; then
     echo ""
     echo "✓ Бот успешно запущен!"
     echo "Логи: tail -f bot.log"
@@ -31,4 +126,4 @@ else
     echo ""
     echo "✗ Ошибка запуска! Проверьте логи: cat bot.log"
     exit 1
-fi
\ No newline at end of file
+fi
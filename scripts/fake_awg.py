@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Фейковый awg / awg-quick для локальных проверок и бенчмарков
+
+Состояние интерфейсов хранится в JSON файле FAKE_AWG_STATE, задержка каждого
+вызова задаётся FAKE_AWG_LATENCY (в секундах). Команда определяется по имени,
+под которым запущен скрипт, поэтому достаточно положить симлинки `awg` и
+`awg-quick` на этот файл в начало PATH (см. install_fake_awg).
+
+Поддерживается:
+    awg set <iface> [peer <key> (allowed-ips <ips> | remove)]...
+    awg show <iface> dump
+    awg-quick save <iface>
+"""
+
+import fcntl
+import json
+import os
+import sys
+import time
+
+
+def install_fake_awg(directory, state_path, latency=0.0):
+    """Создать симлинки awg/awg-quick в directory и вернуть env для запуска"""
+    script = os.path.abspath(__file__)
+    for name in ("awg", "awg-quick"):
+        link = os.path.join(directory, name)
+        if not os.path.exists(link):
+            os.symlink(script, link)
+    os.chmod(script, 0o755)
+    return {
+        "PATH": f"{directory}{os.pathsep}{os.environ.get('PATH', '')}",
+        "FAKE_AWG_STATE": state_path,
+        "FAKE_AWG_LATENCY": str(latency),
+    }
+
+
+def _load(f):
+    f.seek(0)
+    raw = f.read()
+    return json.loads(raw) if raw else {}
+
+
+def _dump(f, state):
+    f.seek(0)
+    f.truncate()
+    f.write(json.dumps(state))
+
+
+def cmd_set(state, iface, args):
+    peers = state.setdefault(iface, {})
+    i = 0
+    while i < len(args):
+        if args[i] != "peer" or i + 1 >= len(args):
+            sys.exit(f"Invalid argument: {args[i]}")
+        key = args[i + 1]
+        i += 2
+        peer = peers.setdefault(key, {"allowed_ips": "(none)", "handshake": 0, "rx": 0, "tx": 0})
+        while i < len(args) and args[i] != "peer":
+            if args[i] == "remove":
+                peers.pop(key, None)
+                i += 1
+            elif args[i] == "allowed-ips":
+                peer["allowed_ips"] = args[i + 1]
+                i += 2
+            else:
+                sys.exit(f"Invalid argument: {args[i]}")
+
+
+def cmd_dump(state, iface):
+    lines = ["(hidden)\tSERVERPUBLICKEY\t51820\toff"]
+    for key, peer in state.get(iface, {}).items():
+        lines.append(
+            f"{key}\t(none)\t(none)\t{peer['allowed_ips']}\t{peer['handshake']}\t"
+            f"{peer['rx']}\t{peer['tx']}\toff"
+        )
+    print("\n".join(lines))
+
+
+def main():
+    time.sleep(float(os.getenv("FAKE_AWG_LATENCY", "0")))
+    tool = os.path.basename(sys.argv[0])
+    args = sys.argv[1:]
+
+    with open(os.environ["FAKE_AWG_STATE"], "a+") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        state = _load(f)
+
+        if tool == "awg-quick" and args[:1] == ["save"]:
+            return
+        if tool == "awg" and args[:1] == ["set"]:
+            cmd_set(state, args[1], args[2:])
+            _dump(f, state)
+        elif tool == "awg" and args[:1] == ["show"] and args[2:3] == ["dump"]:
+            cmd_dump(state, args[1])
+        else:
+            sys.exit(f"fake {tool}: unsupported command {' '.join(args)}")
+
+
+if __name__ == "__main__":
+    main()
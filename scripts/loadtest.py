@@ -0,0 +1,270 @@
+"""
+Нагрузочный тест: синтетические апдейты через настоящий dp из src/main.py
+
+Telegram заменён заглушкой сессии с задержкой ответа, awg / awg-quick —
+фейковым бинарём (scripts/fake_awg.py). Каждый виртуальный пользователь
+проходит /start, создание конфига, профиль, список, скачивание и удаление.
+Результат — JSON с p50/p95/p99 по шагам, пропускной способностью и
+суммарным временем в БД и awg, его удобно сравнивать между версиями.
+
+    python scripts/loadtest.py --users 2000 --concurrency 100 --output result.json
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+sys.path.insert(0, os.path.dirname(__file__))
+
+from fake_awg import install_fake_awg  # noqa: E402
+
+# Первый id виртуальных пользователей, чтобы не пересекаться с ADMIN_ID
+USER_ID_BASE = 1_000_000
+
+
+class ErrorCounter(logging.Handler):
+    """Хендлеры ловят свои исключения и пишут ERROR в лог, здесь они считаются"""
+
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))
+    return ordered[index]
+
+
+def make_stub_session(latency):
+    from aiogram.client.session.base import BaseSession
+    from aiogram.types import Chat, Document, Message
+
+    class StubSession(BaseSession):
+        """Отвечает на любой метод Bot API без сети, с задержкой latency"""
+
+        def __init__(self):
+            super().__init__()
+            self.requests = 0
+            self.uploads = 0
+            self._message_id = 0
+
+        async def make_request(self, bot, method, timeout=None):
+            self.requests += 1
+            if latency:
+                await asyncio.sleep(latency)
+            if not type(method).__name__.startswith(("Send", "Copy", "Forward", "Edit")):
+                return True
+            self._message_id += 1
+            chat_id = getattr(method, "chat_id", 0)
+            document = None
+            if type(method).__name__ == "SendDocument":
+                self.uploads += not isinstance(method.document, str)
+                document = Document(
+                    file_id=f"file{self._message_id}", file_unique_id=f"u{self._message_id}"
+                )
+            return Message(
+                message_id=self._message_id,
+                date=datetime.datetime.now(),
+                chat=Chat(id=chat_id, type="private"),
+                text="",
+                document=document,
+            )
+
+        async def stream_content(
+            self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True
+        ):
+            yield b""
+
+        async def close(self):
+            pass
+
+    return StubSession()
+
+
+class VirtualUsers:
+    def __init__(self, main, think_time):
+        from aiogram.types import CallbackQuery, Chat, Message, Update, User
+
+        self.main = main
+        self.think_time = think_time
+        self.latencies = {}
+        self._update_id = 0
+        self._types = (CallbackQuery, Chat, Message, Update, User)
+
+    def _update(self, user_id, text=None, callback_data=None):
+        CallbackQuery, Chat, Message, Update, User = self._types
+        self._update_id += 1
+        user = User(id=user_id, is_bot=False, first_name=f"user{user_id}", username=f"u{user_id}")
+        message = Message(
+            message_id=self._update_id,
+            date=datetime.datetime.now(),
+            chat=Chat(id=user_id, type="private"),
+            from_user=user,
+            text=text,
+        )
+        if callback_data is None:
+            return Update(update_id=self._update_id, message=message)
+        callback = CallbackQuery(
+            id=str(self._update_id),
+            from_user=user,
+            chat_instance=str(user_id),
+            data=callback_data,
+            message=message,
+        )
+        return Update(update_id=self._update_id, callback_query=callback)
+
+    async def _feed(self, step, update):
+        started = time.perf_counter()
+        await self.main.dp.feed_update(self.main.bot, update)
+        self.latencies.setdefault(step, []).append(time.perf_counter() - started)
+        if self.think_time:
+            await asyncio.sleep(self.think_time)
+
+    async def run(self, user_id):
+        await self._feed("start", self._update(user_id, "/start"))
+        await self._feed("get_vpn", self._update(user_id, "Получить VPN"))
+        await self._feed("create", self._update(user_id, "laptop"))
+        await self._feed("profile", self._update(user_id, "Мой профиль"))
+        await self._feed("manage", self._update(user_id, "Управлять VPN"))
+
+        configs = await self.main.adb.list_vpn_configs(user_id)
+        if not configs:
+            return
+        config_id = configs[0]["id"]
+        await self._feed("download", self._update(user_id, callback_data=f"download_{config_id}"))
+        await self._feed("delete", self._update(user_id, callback_data=f"delete_{config_id}"))
+
+
+def histogram_totals(histogram):
+    totals = {}
+    for labels, sample in histogram.summary().items():
+        totals[" ".join(labels)] = {
+            "count": sample["count"],
+            "seconds": round(sample["sum"], 4),
+        }
+    return totals
+
+
+async def run(args, errors):
+    import main
+    from metrics import AWG_SECONDS, DB_SECONDS, TELEGRAM_SECONDS
+    from middlewares import RateLimitMiddleware
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    # Заглушка получает те же request middleware, что и настоящая сессия бота
+    session = make_stub_session(args.api_latency)
+    for middleware in main.bot.session.middleware:
+        if args.ratelimit or not isinstance(middleware, RateLimitMiddleware):
+            session.middleware(middleware)
+    main.bot.session = session
+
+    main.key_pool.start()
+    users = VirtualUsers(main, args.think_time)
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def virtual_user(user_id):
+        async with semaphore:
+            await users.run(user_id)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(virtual_user(USER_ID_BASE + i) for i in range(args.users)))
+    elapsed = time.perf_counter() - started
+
+    main.key_pool.close()
+    main.adb.close()
+
+    updates = sum(len(values) for values in users.latencies.values())
+    return {
+        "users": args.users,
+        "concurrency": args.concurrency,
+        "api_latency": args.api_latency,
+        "awg_latency": args.awg_latency,
+        "duration": round(elapsed, 3),
+        "updates": updates,
+        "updates_per_second": round(updates / elapsed, 1),
+        "errors": errors.count,
+        "steps": {
+            step: {
+                "count": len(values),
+                "p50": round(percentile(values, 0.50), 4),
+                "p95": round(percentile(values, 0.95), 4),
+                "p99": round(percentile(values, 0.99), 4),
+                "max": round(max(values), 4),
+            }
+            for step, values in users.latencies.items()
+        },
+        "telegram_requests": main.bot.session.requests,
+        "telegram_uploads": main.bot.session.uploads,
+        "db": histogram_totals(DB_SECONDS),
+        "awg": histogram_totals(AWG_SECONDS),
+        "telegram": histogram_totals(TELEGRAM_SECONDS),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--api-latency", type=float, default=0.05, help="ответ Telegram, с")
+    parser.add_argument("--awg-latency", type=float, default=0.01, help="вызов awg, с")
+    parser.add_argument("--think-time", type=float, default=0.0, help="пауза между шагами, с")
+    parser.add_argument(
+        "--ratelimit",
+        action="store_true",
+        help="включить лимиты исходящих запросов (тогда они и ограничат пропускную способность)",
+    )
+    parser.add_argument("--output", help="файл для JSON, по умолчанию stdout")
+    args = parser.parse_args()
+    output_path = os.path.abspath(args.output) if args.output else None
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ.update(install_fake_awg(tmp, os.path.join(tmp, "state.json"), args.awg_latency))
+        # Бот импортируется с временной базой и без фоновых задач и сервера метрик
+        os.environ.update(
+            {
+                "BOT_TOKEN": "123456:loadtest",
+                "ADMIN_ID": "1",
+                "WG_SERVER_PUBLIC_KEY": "loadtest-server-key",
+                "WG_SERVER_ENDPOINT": "127.0.0.1:51820",
+                "VPN_SUBNET": "10.0.0.0/12",
+                "METRICS_PORT": "0",
+                "STATS_INTERVAL": "0",
+                "PEER_IDLE_DAYS": "0",
+                # виртуальные пользователи жмут кнопки без пауз, флуд-контроль их бы резал
+                "FLOOD_BURST": "1000",
+                "FLOOD_WINDOW_MAX": "1000",
+            }
+        )
+        os.chdir(tmp)
+        os.makedirs("data", exist_ok=True)
+
+        errors = ErrorCounter()
+        logging.getLogger().addHandler(errors)
+        try:
+            result = asyncio.run(run(args, errors))
+        finally:
+            os.chdir(cwd)
+
+    output = json.dumps(result, ensure_ascii=False, indent=2)
+    if output_path:
+        with open(output_path, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+import asyncio
+import logging
+import time
+
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest, TelegramForbiddenError
+
+from config import ADMIN_ID, BROADCAST_PAGE, BROADCAST_WORKERS
+from ratelimit import background_sends
+
+logger = logging.getLogger(__name__)
+
+
+class Broadcaster:
+    """
+    Рассылка сообщения всем активным пользователям
+
+    Пользователи читаются страницами по BROADCAST_PAGE через курсор по
+    user_id, страница раздаётся BROADCAST_WORKERS воркерам. После каждой
+    страницы курсор и счётчики сохраняются в broadcasts, поэтому после
+    рестарта рассылка продолжается с места остановки (повторно может уйти
+    не больше одной страницы). Запросы идут фоновым приоритетом лимитера.
+    Заблокировавшие бота и удалённые аккаунты помечаются неактивными.
+    """
+
+    def __init__(self, bot, adb, workers=BROADCAST_WORKERS, page=BROADCAST_PAGE):
+        self.bot = bot
+        self.adb = adb
+        self.workers = workers
+        self.page = page
+        self._tasks = {}
+
+    @property
+    def running(self):
+        return list(self._tasks)
+
+    async def start(self, text):
+        broadcast_id = await self.adb.create_broadcast(text)
+        self._spawn(broadcast_id)
+        return broadcast_id
+
+    async def resume(self):
+        """Продолжить рассылки, прерванные остановкой бота"""
+        for broadcast in await self.adb.get_running_broadcasts():
+            logger.info(
+                f"Продолжаем рассылку {broadcast['id']} с user_id > {broadcast['last_user_id']}"
+            )
+            self._spawn(broadcast["id"])
+
+    async def cancel(self, broadcast_id):
+        task = self._tasks.get(broadcast_id)
+        if task is None:
+            return False
+        task.cancel()
+        await self.adb.finish_broadcast(broadcast_id, "cancelled")
+        return True
+
+    def stop(self):
+        """Остановить воркеры при выключении бота, рассылки остаются running"""
+        for task in self._tasks.values():
+            task.cancel()
+
+    def _spawn(self, broadcast_id):
+        with background_sends():
+            task = asyncio.ensure_future(self._run(broadcast_id))
+        self._tasks[broadcast_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(broadcast_id, None))
+
+    async def _send(self, user_id, text):
+        """
+        Returns:
+            str: "sent", "blocked" или "failed"
+        """
+        try:
+            await self.bot.send_message(user_id, text)
+            return "sent"
+        except TelegramForbiddenError:
+            return "blocked"
+        except TelegramBadRequest as e:
+            if "chat not found" in e.message.lower():
+                return "blocked"
+            logger.warning(f"Рассылка пользователю {user_id}: {e}")
+            return "failed"
+        except TelegramAPIError as e:
+            # 429 после всех повторов, сетевые ошибки и ошибки сервера Telegram
+            logger.warning(f"Рассылка пользователю {user_id}: {e}")
+            return "failed"
+
+    async def _send_page(self, user_ids, text):
+        results = {"sent": 0, "blocked": 0, "failed": 0}
+        blocked = []
+        queue = asyncio.Queue()
+        for user_id in user_ids:
+            queue.put_nowait(user_id)
+
+        async def worker():
+            while not queue.empty():
+                user_id = queue.get_nowait()
+                result = await self._send(user_id, text)
+                results[result] += 1
+                if result == "blocked":
+                    blocked.append(user_id)
+
+        await asyncio.gather(*(worker() for _ in range(min(self.workers, len(user_ids)))))
+        if blocked:
+            await self.adb.deactivate_users(blocked)
+        return results
+
+    async def _run(self, broadcast_id):
+        broadcast = await self.adb.get_broadcast(broadcast_id)
+        text = broadcast["text"]
+        cursor = broadcast["last_user_id"]
+        started = time.monotonic()
+        processed = 0
+
+        try:
+            while True:
+                user_ids = await self.adb.iter_active_user_ids(cursor, self.page)
+                if not user_ids:
+                    break
+                results = await self._send_page(user_ids, text)
+                cursor = user_ids[-1]
+                processed += len(user_ids)
+                await self.adb.save_broadcast_progress(
+                    broadcast_id, cursor, results["sent"], results["failed"], results["blocked"]
+                )
+        except asyncio.CancelledError:
+            logger.info(f"Рассылка {broadcast_id} остановлена на user_id {cursor}")
+            raise
+        except Exception as e:
+            # курсор сохранён, рассылка продолжится после рестарта
+            logger.error(f"Ошибка рассылки {broadcast_id}: {e}")
+            return
+
+        await self.adb.finish_broadcast(broadcast_id)
+        broadcast = await self.adb.get_broadcast(broadcast_id)
+        elapsed = time.monotonic() - started
+        rate = processed / elapsed if elapsed else 0
+        report = (
+            f"Рассылка {broadcast_id} завершена за {elapsed:.0f}с ({rate:.1f} сообщ./с)\n"
+            f"Доставлено: {broadcast['sent']}\n"
+            f"Заблокировали бота / удалены: {broadcast['blocked']}\n"
+            f"Ошибки: {broadcast['failed']}"
+        )
+        logger.info(report)
+        if ADMIN_ID:
+            try:
+                await self.bot.send_message(ADMIN_ID, report)
+            except (TelegramBadRequest, TelegramForbiddenError) as e:
+                logger.warning(f"Отчёт о рассылке не отправлен: {e}")
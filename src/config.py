@@ -0,0 +1,165 @@
+import json
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+BOT_TOKEN = os.getenv("BOT_TOKEN")
+ADMIN_ID = int(os.getenv("ADMIN_ID", "0"))
+
+# Получение апдейтов: polling | webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+# Публичный адрес, на который Telegram шлёт апдейты (без пути). Если пусто,
+# вебхук не регистрируется — удобно для локальной отладки
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_MAX_CONCURRENCY = int(os.getenv("WEBHOOK_MAX_CONCURRENCY", "50"))
+
+SERVER_PUBLIC_KEY = os.getenv("WG_SERVER_PUBLIC_KEY")
+SERVER_ENDPOINT = os.getenv("WG_SERVER_ENDPOINT")
+WG_INTERFACE = os.getenv("WG_INTERFACE", "wg0")
+
+# FSM: сколько секунд хранить незавершённый диалог, сколько ключей держать
+# в памяти и как часто чистить устаревшие записи
+FSM_TTL = int(os.getenv("FSM_TTL", str(24 * 3600)))
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", "2048"))
+FSM_PURGE_INTERVAL = int(os.getenv("FSM_PURGE_INTERVAL", "600"))
+
+# Ограничения на вызовы awg / awg-quick
+AWG_TIMEOUT = float(os.getenv("AWG_TIMEOUT", "10"))
+AWG_CONCURRENCY = int(os.getenv("AWG_CONCURRENCY", "4"))
+# Таймаут соединения ssh backend, должен быть меньше AWG_TIMEOUT
+SSH_CONNECT_TIMEOUT = int(os.getenv("SSH_CONNECT_TIMEOUT", "5"))
+
+# Окно, за которое копятся изменения пиров перед одним вызовом awg set
+AWG_BATCH_WINDOW = float(os.getenv("AWG_BATCH_WINDOW", "0.2"))
+AWG_BATCH_MAX = int(os.getenv("AWG_BATCH_MAX", "200"))
+
+# SQLite: размер пула соединений и таймаут ожидания блокировки (секунды)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))
+DB_BUSY_TIMEOUT = float(os.getenv("DB_BUSY_TIMEOUT", "5"))
+
+# Сколько конфигов может создать пользователь без личной квоты и тарифа
+DEFAULT_CONFIG_QUOTA = int(os.getenv("DEFAULT_CONFIG_QUOTA", "5"))
+
+# Кеш строк пользователей и списков конфигов в памяти
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "300"))
+
+# Подсеть клиентов. Первый адрес занимает сервер, Address в wg0.conf должен
+# покрывать всю подсеть
+VPN_SUBNET = os.getenv("VPN_SUBNET", "10.0.0.0/24")
+
+# Пул готовых пар ключей: догенерируется до KEY_POOL_HIGH, когда падает ниже KEY_POOL_LOW
+KEY_POOL_LOW = int(os.getenv("KEY_POOL_LOW", "16"))
+KEY_POOL_HIGH = int(os.getenv("KEY_POOL_HIGH", "64"))
+
+# Параметры клиентского конфига. Jc/Jmin/Jmax/S1/S2/H1-H4 должны совпадать
+# с [Interface] сервера
+CLIENT_DNS = os.getenv("CLIENT_DNS", "1.1.1.1, 8.8.8.8")
+CLIENT_MTU = int(os.getenv("CLIENT_MTU", "1280"))
+CLIENT_ALLOWED_IPS = os.getenv("CLIENT_ALLOWED_IPS", "0.0.0.0/0, ::/0")
+CLIENT_KEEPALIVE = int(os.getenv("CLIENT_KEEPALIVE", "10"))
+AWG_OBFUSCATION = {
+    key: int(os.getenv(f"AWG_{key.upper()}", default))
+    for key, default in (
+        ("Jc", "5"),
+        ("Jmin", "50"),
+        ("Jmax", "1000"),
+        ("S1", "86"),
+        ("S2", "123"),
+        ("H1", "1234567"),
+        ("H2", "2345678"),
+        ("H3", "3456789"),
+        ("H4", "4567890"),
+    )
+}
+
+# Сколько готовых .conf держать в памяти
+CONFIG_CACHE_SIZE = int(os.getenv("CONFIG_CACHE_SIZE", "1024"))
+
+# Серверы AmneziaWG. Без WG_SERVERS_FILE работает один сервер "default"
+# из переменных WG_SERVER_* / WG_INTERFACE / VPN_SUBNET. Формат файла —
+# JSON список объектов с полями name, endpoint, public_key, subnet и
+# необязательными interface, region, capacity, backend (local | ssh | fake),
+# host (для ssh), dns, mtu, obfuscation
+DEFAULT_SERVER = "default"
+WG_SERVERS_FILE = os.getenv("WG_SERVERS_FILE")
+if WG_SERVERS_FILE:
+    with open(WG_SERVERS_FILE, encoding="utf-8") as f:
+        WG_SERVERS = json.load(f)
+else:
+    WG_SERVERS = [
+        {
+            "name": DEFAULT_SERVER,
+            "interface": WG_INTERFACE,
+            "endpoint": SERVER_ENDPOINT,
+            "public_key": SERVER_PUBLIC_KEY,
+            "subnet": VPN_SUBNET,
+        }
+    ]
+
+# Выбор сервера для нового конфига: least_loaded | round_robin | region
+PLACEMENT_STRATEGY = os.getenv("PLACEMENT_STRATEGY", "least_loaded")
+# Регион по умолчанию для стратегии region
+PLACEMENT_REGION = os.getenv("PLACEMENT_REGION")
+
+# Сверка пиров в БД и на интерфейсах: при старте и каждые RECONCILE_INTERVAL
+# секунд (0 — только при старте)
+RECONCILE_INTERVAL = int(os.getenv("RECONCILE_INTERVAL", "600"))
+
+# Сбор статистики пиров: период опроса, размер часового бакета, через сколько
+# дней часы сворачиваются в дни и сколько дней хранить дневные итоги
+STATS_INTERVAL = int(os.getenv("STATS_INTERVAL", "300"))
+STATS_BUCKET = 3600
+STATS_HOURLY_DAYS = int(os.getenv("STATS_HOURLY_DAYS", "7"))
+STATS_RETENTION_DAYS = int(os.getenv("STATS_RETENTION_DAYS", "90"))
+
+# Пиры без рукопожатия дольше PEER_IDLE_DAYS дней снимаются с интерфейса
+# (0 — не снимать), проверка раз в PEER_IDLE_INTERVAL секунд
+PEER_IDLE_DAYS = int(os.getenv("PEER_IDLE_DAYS", "30"))
+PEER_IDLE_INTERVAL = int(os.getenv("PEER_IDLE_INTERVAL", "3600"))
+
+# HTTP сервер с метриками в формате Prometheus (/metrics), 0 — выключить
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+
+# Лимиты исходящих запросов к Telegram: общий на бота (запросов в секунду и
+# всплеск), на один чат, доля общего лимита для фоновых рассылок и сколько
+# раз повторять запрос после 429
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "30"))
+TG_GLOBAL_BURST = int(os.getenv("TG_GLOBAL_BURST", "30"))
+TG_CHAT_RATE = float(os.getenv("TG_CHAT_RATE", "1"))
+TG_CHAT_BURST = int(os.getenv("TG_CHAT_BURST", "3"))
+TG_BACKGROUND_SHARE = float(os.getenv("TG_BACKGROUND_SHARE", "0.8"))
+TG_MAX_RETRIES = int(os.getenv("TG_MAX_RETRIES", "3"))
+
+# Рассылки: сколько сообщений отправляется параллельно и сколько
+# пользователей читается из базы за раз (шаг сохранения прогресса)
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "20"))
+BROADCAST_PAGE = int(os.getenv("BROADCAST_PAGE", "200"))
+
+# Максимум конфигов за одну команду /bulk и владелец этих конфигов: не
+# настоящий пользователь, чтобы они не попадали в список конфигов админа
+BULK_MAX = int(os.getenv("BULK_MAX", "100"))
+BULK_OWNER_ID = int(os.getenv("BULK_OWNER_ID", "0"))
+
+# Обработка апдейтов: сколько хендлеров работает одновременно и сколько
+# апдейтов одного пользователя может ждать своей очереди
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "100"))
+USER_QUEUE_MAX = int(os.getenv("USER_QUEUE_MAX", "10"))
+
+# Защита от флуда входящими апдейтами: в среднем FLOOD_RATE апдейтов в
+# секунду со всплеском до FLOOD_BURST и не больше FLOOD_WINDOW_MAX за
+# FLOOD_WINDOW секунд на пользователя, ADMIN_ID не ограничивается
+FLOOD_RATE = float(os.getenv("FLOOD_RATE", "1"))
+FLOOD_BURST = int(os.getenv("FLOOD_BURST", "5"))
+FLOOD_WINDOW = int(os.getenv("FLOOD_WINDOW", "60"))
+FLOOD_WINDOW_MAX = int(os.getenv("FLOOD_WINDOW_MAX", "40"))
+
+# Сколько секунд при остановке ждать принятые апдейты и очереди пиров
+SHUTDOWN_TIMEOUT = int(os.getenv("SHUTDOWN_TIMEOUT", "30"))
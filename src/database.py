@@ -1,86 +1,722 @@
-import sqlite3
+import asyncio
+import ipaddress
+import logging
 import os
+import queue
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from config import (
+    DB_BUSY_TIMEOUT,
+    DB_POOL_SIZE,
+    DEFAULT_CONFIG_QUOTA,
+    DEFAULT_SERVER,
+    USER_CACHE_SIZE,
+    USER_CACHE_TTL,
+    WG_SERVERS,
+)
+from metrics import DB_ERRORS, DB_SECONDS, DB_WAIT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Первый адрес подсети отдан серверу, клиенты начинаются со второго
+FIRST_CLIENT_OFFSET = 2
+
+# Сколько подготовленных выражений sqlite3 держит в кеше на соединение
+STATEMENT_CACHE_SIZE = 256
+
+
+class IpPoolExhausted(Exception):
+    """В подсети не осталось свободных адресов"""
+
+
+def _migrate_initial(cursor):
+    """users и vpn_configs"""
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """
+    )
+
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS vpn_configs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            name TEXT NOT NULL,
+            private_key TEXT NOT NULL,
+            public_key TEXT NOT NULL,
+            ip_address TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(user_id),
+            UNIQUE(user_id, name)
+        )
+    """
+    )
+
+
+def _migrate_ip_pools(cursor):
+    """аллокатор IP адресов"""
+    # next_offset — ещё ни разу не выданный хвост подсети,
+    # free_ips — освобождённые адреса для повторной выдачи
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS ip_pools (
+            name TEXT PRIMARY KEY,
+            network TEXT NOT NULL,
+            next_offset INTEGER NOT NULL
+        )
+    """
+    )
+
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS free_ips (
+            pool TEXT NOT NULL,
+            host INTEGER NOT NULL,
+            PRIMARY KEY (pool, host)
+        ) WITHOUT ROWID
+    """
+    )
+
+
+def _migrate_server_column(cursor):
+    """vpn_configs.server"""
+    cursor.execute("PRAGMA table_info(vpn_configs)")
+    if "server" not in {row["name"] for row in cursor.fetchall()}:
+        cursor.execute(
+            f"ALTER TABLE vpn_configs ADD COLUMN server TEXT NOT NULL DEFAULT '{DEFAULT_SERVER}'"
+        )
+
+
+def _migrate_fsm_states(cursor):
+    """fsm_states"""
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS fsm_states (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    """
+    )
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_fsm_states_updated_at ON fsm_states(updated_at)")
+
+
+def _migrate_config_indexes(cursor):
+    """индексы vpn_configs"""
+    # Список конфигов пользователя: покрывающий индекс, без сортировки и
+    # без чтения строк с приватными ключами
+    cursor.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_vpn_configs_user_created
+        ON vpn_configs(user_id, created_at DESC, name, ip_address, server)
+    """
+    )
+    # Один адрес — один пир на сервере; заодно покрывает загрузку серверов
+    cursor.execute(
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_vpn_configs_server_ip
+        ON vpn_configs(server, ip_address)
+    """
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_vpn_configs_public_key ON vpn_configs(public_key)"
+    )
+
+
+def _migrate_quotas(cursor):
+    """квоты конфигов"""
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS quota_tiers (
+            name TEXT PRIMARY KEY,
+            max_configs INTEGER NOT NULL
+        )
+    """
+    )
+    # Личная квота важнее тарифа, без обоих действует DEFAULT_CONFIG_QUOTA
+    cursor.execute("ALTER TABLE users ADD COLUMN tier TEXT REFERENCES quota_tiers(name)")
+    cursor.execute("ALTER TABLE users ADD COLUMN config_quota INTEGER")
+
+
+def _migrate_peer_stats(cursor):
+    """статистика трафика пиров"""
+    # Последние счётчики awg по пиру: из них считаются приращения,
+    # итоги и время последнего рукопожатия
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS peer_stats (
+            config_id INTEGER PRIMARY KEY,
+            last_handshake INTEGER NOT NULL DEFAULT 0,
+            rx_total INTEGER NOT NULL DEFAULT 0,
+            tx_total INTEGER NOT NULL DEFAULT 0,
+            last_rx INTEGER NOT NULL DEFAULT 0,
+            last_tx INTEGER NOT NULL DEFAULT 0,
+            updated_at INTEGER NOT NULL
+        )
+    """
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_peer_stats_handshake ON peer_stats(last_handshake)"
+    )
+    # Приращения трафика по часам, старые часы сворачиваются в дни
+    for table, column in (("peer_traffic", "bucket"), ("peer_traffic_daily", "day")):
+        cursor.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                config_id INTEGER NOT NULL,
+                {column} INTEGER NOT NULL,
+                rx INTEGER NOT NULL,
+                tx INTEGER NOT NULL,
+                PRIMARY KEY (config_id, {column})
+            ) WITHOUT ROWID
+        """
+        )
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_{column} ON {table}({column})")
+
+
+def _migrate_peer_active(cursor):
+    """отключение простаивающих пиров"""
+    # active = 0: пир снят с интерфейса, строка, ключи и IP остаются.
+    # activated_at — время последнего включения, чтобы только что
+    # включённый пир без свежего рукопожатия не сняли снова
+    cursor.execute("ALTER TABLE vpn_configs ADD COLUMN active INTEGER NOT NULL DEFAULT 1")
+    cursor.execute("ALTER TABLE vpn_configs ADD COLUMN activated_at INTEGER NOT NULL DEFAULT 0")
+
+
+def _migrate_broadcasts(cursor):
+    """рассылки"""
+    # active = 0: бот заблокирован или аккаунт удалён, рассылки его пропускают
+    cursor.execute("ALTER TABLE users ADD COLUMN active INTEGER NOT NULL DEFAULT 1")
+    # last_user_id — курсор рассылки: все пользователи до него уже обработаны
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            last_user_id INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+    """
+    )
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_broadcasts_status ON broadcasts(status)")
+
+
+def _migrate_config_files(cursor):
+    """file_id загруженных в Telegram конфигов"""
+    # fingerprint — отпечаток шаблона сервера, с которым файл был загружен
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS config_files (
+            config_id INTEGER PRIMARY KEY,
+            fingerprint TEXT NOT NULL,
+            file_id TEXT NOT NULL
+        )
+    """
+    )
+
+
+def _migrate_server_loads(cursor):
+    """счётчик конфигов по серверам"""
+    # Выбор сервера при каждом создании конфига читает эту таблицу вместо
+    # COUNT(*) ... GROUP BY по всем конфигам; меняется в тех же транзакциях,
+    # что и vpn_configs
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS server_loads (
+            server TEXT PRIMARY KEY,
+            configs INTEGER NOT NULL DEFAULT 0
+        )
+    """
+    )
+    cursor.execute(
+        """
+        INSERT OR REPLACE INTO server_loads (server, configs)
+        SELECT server, COUNT(*) FROM vpn_configs GROUP BY server
+    """
+    )
+
+
+# Миграции по порядку, номер применённой хранится в PRAGMA user_version.
+# Новые миграции добавляются только в конец. Первые написаны идемпотентно,
+# чтобы базы, созданные до появления версий, проходили их без ошибок
+MIGRATIONS = [
+    _migrate_initial,
+    _migrate_ip_pools,
+    _migrate_server_column,
+    _migrate_fsm_states,
+    _migrate_config_indexes,
+    _migrate_quotas,
+    _migrate_peer_stats,
+    _migrate_peer_active,
+    _migrate_broadcasts,
+    _migrate_config_files,
+    _migrate_server_loads,
+]
+
+
+class QuotaExceeded(Exception):
+    """У пользователя уже максимум конфигов"""
+
+    def __init__(self, quota):
+        super().__init__(f"Достигнут лимит конфигов: {quota}")
+        self.quota = quota
+
+
+class UserCache:
+    """
+    LRU кеш с TTL для данных одного пользователя (строка users, список конфигов)
+
+    Методы Database работают в разных потоках. Чтобы чтение, начатое до
+    записи, не положило в кеш устаревшие данные уже после инвалидации,
+    результат кладётся только если с начала чтения не было ни одной
+    инвалидации (см. generation).
+    """
+
+    def __init__(self, max_size=USER_CACHE_SIZE, ttl=USER_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None or time.monotonic() - item[1] > self.ttl:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def generation(self):
+        with self._lock:
+            return self._generation
+
+    def put(self, key, value, generation):
+        with self._lock:
+            if generation != self._generation or self.max_size <= 0:
+                return
+            self._items[key] = (value, time.monotonic())
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._generation += 1
+            self._items.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._items), "hits": self.hits, "misses": self.misses}
 
 
 class Database:
-    def __init__(self, db_path="data/bot.db"):
+    def __init__(self, db_path="data/bot.db", pool_size=DB_POOL_SIZE, ip_pools=None):
         self.db_path = db_path
+        self.pool_size = pool_size
+        # У каждого сервера своя подсеть и свой пул адресов
+        if ip_pools is None:
+            ip_pools = {server["name"]: server["subnet"] for server in WG_SERVERS}
+        self.ip_pools = {name: ipaddress.ip_network(subnet) for name, subnet in ip_pools.items()}
+
+        self._users = UserCache()
+        self._config_lists = UserCache()
+
+        self._pool = queue.LifoQueue()
+        self._connections = []
+        self._pool_lock = threading.Lock()
 
         os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
 
         self.init_db()
 
-    def get_connection(self):
-        conn = sqlite3.connect(self.db_path)
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=DB_BUSY_TIMEOUT,
+            check_same_thread=False,
+            cached_statements=STATEMENT_CACHE_SIZE,
+        )
         conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={int(DB_BUSY_TIMEOUT * 1000)}")
         return conn
 
+    def _acquire(self):
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._pool_lock:
+            if len(self._connections) < self.pool_size:
+                conn = self._connect()
+                self._connections.append(conn)
+                return conn
+
+        return self._pool.get()
+
+    @contextmanager
+    def get_connection(self):
+        """
+        Взять соединение из пула
+
+        Соединения живут всё время работы бота. По выходу из блока транзакция
+        фиксируется (или откатывается при исключении), а соединение
+        возвращается в пул.
+        """
+        conn = self._acquire()
+        try:
+            with conn:
+                yield conn
+        finally:
+            self._pool.put(conn)
+
+    def close(self):
+        """Закрыть все соединения пула"""
+        with self._pool_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+            self._pool = queue.LifoQueue()
+
     def init_db(self):
+        """Применить недостающие миграции и синхронизировать пулы адресов с конфигом"""
+        with self.get_connection() as conn:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+                conn.execute("BEGIN")
+                migration(conn.cursor())
+                conn.execute(f"PRAGMA user_version = {number}")
+                conn.commit()
+                logger.info(f"Миграция БД {number}: {migration.__doc__}")
+
         with self.get_connection() as conn:
             cursor = conn.cursor()
+            for name, network in self.ip_pools.items():
+                self._init_ip_pool(cursor, name, network)
+
+    def _init_ip_pool(self, cursor, name, network):
+        cursor.execute("SELECT network FROM ip_pools WHERE name = ?", (name,))
+        row = cursor.fetchone()
 
+        if row:
+            stored = ipaddress.ip_network(row["network"])
+            if stored == network:
+                return
+            # Расширять подсеть можно, если её начало не сдвигается:
+            # смещения уже выданных адресов остаются валидными
+            if stored.network_address != network.network_address or not stored.subnet_of(network):
+                raise ValueError(f"Нельзя сменить подсеть пула {name}: {stored} -> {network}")
+            cursor.execute("UPDATE ip_pools SET network = ? WHERE name = ?", (str(network), name))
+            logger.info(f"Подсеть пула {name} расширена: {stored} -> {network}")
+            return
+
+        # Первый запуск аллокатора на существующей базе: занятые адреса
+        # берём из vpn_configs, дыры между ними сразу кладём в free-list
+        cursor.execute("SELECT ip_address FROM vpn_configs WHERE server = ?", (name,))
+        used = set()
+        for (ip,) in cursor.fetchall():
+            address = ipaddress.ip_address(ip)
+            if address in network:
+                used.add(int(address) - int(network.network_address))
+
+        next_offset = max(used, default=FIRST_CLIENT_OFFSET - 1) + 1
+        cursor.execute(
+            "INSERT INTO ip_pools (name, network, next_offset) VALUES (?, ?, ?)",
+            (name, str(network), next_offset),
+        )
+        cursor.executemany(
+            "INSERT INTO free_ips (pool, host) VALUES (?, ?)",
+            [
+                (name, offset)
+                for offset in range(FIRST_CLIENT_OFFSET, next_offset)
+                if offset not in used
+            ],
+        )
+
+    def _allocate_ip(self, cursor, pool=DEFAULT_SERVER):
+        """Выдать адрес: сначала из освобождённых, иначе следующий из хвоста подсети"""
+        cursor.execute("SELECT network, next_offset FROM ip_pools WHERE name = ?", (pool,))
+        pool_row = cursor.fetchone()
+        network = ipaddress.ip_network(pool_row["network"])
+
+        cursor.execute("SELECT host FROM free_ips WHERE pool = ? ORDER BY host LIMIT 1", (pool,))
+        row = cursor.fetchone()
+        if row:
+            offset = row["host"]
+            cursor.execute("DELETE FROM free_ips WHERE pool = ? AND host = ?", (pool, offset))
+        else:
+            offset = pool_row["next_offset"]
+            # Последний адрес подсети — broadcast
+            if offset >= network.num_addresses - 1:
+                raise IpPoolExhausted("IP адреса закончились")
             cursor.execute(
-                """
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id INTEGER PRIMARY KEY,
-                    username TEXT,
-                    first_name TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """
+                "UPDATE ip_pools SET next_offset = next_offset + 1 WHERE name = ?", (pool,)
             )
 
+        return str(network.network_address + offset)
+
+    def _reserve_ip(self, cursor, ip_address, pool=DEFAULT_SERVER):
+        """Пометить занятым адрес, выбранный вручную"""
+        cursor.execute("SELECT network, next_offset FROM ip_pools WHERE name = ?", (pool,))
+        pool_row = cursor.fetchone()
+        if not pool_row:
+            return
+        network = ipaddress.ip_network(pool_row["network"])
+        address = ipaddress.ip_address(ip_address)
+        if address not in network:
+            return
+
+        offset = int(address) - int(network.network_address)
+        next_offset = pool_row["next_offset"]
+        if offset < next_offset:
+            cursor.execute("DELETE FROM free_ips WHERE pool = ? AND host = ?", (pool, offset))
+            return
+
+        cursor.executemany(
+            "INSERT OR IGNORE INTO free_ips (pool, host) VALUES (?, ?)",
+            [(pool, host) for host in range(next_offset, offset)],
+        )
+        cursor.execute("UPDATE ip_pools SET next_offset = ? WHERE name = ?", (offset + 1, pool))
+
+    def _release_ip(self, cursor, ip_address, pool=DEFAULT_SERVER):
+        cursor.execute("SELECT network, next_offset FROM ip_pools WHERE name = ?", (pool,))
+        pool_row = cursor.fetchone()
+        if not pool_row:
+            return
+        network = ipaddress.ip_network(pool_row["network"])
+        address = ipaddress.ip_address(ip_address)
+        if address not in network:
+            return
+
+        offset = int(address) - int(network.network_address)
+        if FIRST_CLIENT_OFFSET <= offset < pool_row["next_offset"]:
             cursor.execute(
-                """
-                CREATE TABLE IF NOT EXISTS vpn_configs (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    name TEXT NOT NULL,
-                    private_key TEXT NOT NULL,
-                    public_key TEXT NOT NULL,
-                    ip_address TEXT NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users(user_id),
-                    UNIQUE(user_id, name)
-                )
-            """
+                "INSERT OR IGNORE INTO free_ips (pool, host) VALUES (?, ?)", (pool, offset)
             )
 
-            conn.commit()
+    def _count_configs(self, cursor, server, delta):
+        """Изменить счётчик конфигов сервера в server_loads"""
+        cursor.execute(
+            """
+            INSERT INTO server_loads (server, configs) VALUES (?, ?)
+            ON CONFLICT(server) DO UPDATE SET configs = configs + excluded.configs
+        """,
+            (server, delta),
+        )
 
     def add_user(self, user_id, username=None, first_name=None):
-        """Добавить пользователя"""
+        """Добавить пользователя или обновить его имя"""
+        cached = self._users.get(user_id)
+        if (
+            cached
+            and cached["active"]
+            and cached["username"] == username
+            and cached["first_name"] == first_name
+        ):
+            return
+
         with self.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 """
-                INSERT OR IGNORE INTO users (user_id, username, first_name)
+                INSERT INTO users (user_id, username, first_name)
                 VALUES (?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    username = excluded.username,
+                    first_name = excluded.first_name,
+                    active = 1
             """,
                 (user_id, username, first_name),
             )
             conn.commit()
+        self._users.invalidate(user_id)
 
     def get_user(self, user_id):
         """Получить пользователя"""
+        user = self._users.get(user_id)
+        if user is not None:
+            return user
+
+        generation = self._users.generation()
         with self.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
             row = cursor.fetchone()
-            return dict(row) if row else None
+            user = dict(row) if row else None
+
+        if user:
+            self._users.put(user_id, user, generation)
+        return user
 
-    def add_vpn_config(self, user_id, name, private_key, public_key, ip_address):
+    def add_vpn_config(
+        self, user_id, name, private_key, public_key, ip_address, server=DEFAULT_SERVER
+    ):
         with self.get_connection() as conn:
             cursor = conn.cursor()
+            self._reserve_ip(cursor, ip_address, server)
             cursor.execute(
                 """
-                INSERT INTO vpn_configs (user_id, name, private_key, public_key, ip_address)
-                VALUES (?, ?, ?, ?, ?)
+                INSERT INTO vpn_configs
+                    (user_id, name, private_key, public_key, ip_address, server)
+                VALUES (?, ?, ?, ?, ?, ?)
             """,
-                (user_id, name, private_key, public_key, ip_address),
+                (user_id, name, private_key, public_key, ip_address, server),
             )
+            config_id = cursor.lastrowid
+            self._count_configs(cursor, server, 1)
             conn.commit()
-            return cursor.lastrowid
+        self._config_lists.invalidate(user_id)
+        return config_id
+
+    def create_vpn_config(
+        self, user_id, name, private_key, public_key, server=DEFAULT_SERVER, enforce_quota=True
+    ):
+        """
+        Создать конфиг с новым IP адресом из пула сервера
+
+        Квота проверяется, а адрес выделяется в той же транзакции, что и
+        вставка конфига, поэтому два одновременных создания не превысят
+        лимит и не получат один IP, а при ошибке вставки адрес не теряется.
+
+        Raises:
+            QuotaExceeded: у пользователя уже максимум конфигов
+
+        Returns:
+            dict: {"id": ..., "ip_address": ...}
+        """
+        with self.get_connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            cursor = conn.cursor()
+            if enforce_quota:
+                count, quota = self._quota_usage(cursor, user_id)
+                if count >= quota:
+                    raise QuotaExceeded(quota)
+            ip_address = self._allocate_ip(cursor, server)
+            cursor.execute(
+                """
+                INSERT INTO vpn_configs
+                    (user_id, name, private_key, public_key, ip_address, server)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """,
+                (user_id, name, private_key, public_key, ip_address, server),
+            )
+            created = {"id": cursor.lastrowid, "ip_address": ip_address}
+            self._count_configs(cursor, server, 1)
+        self._config_lists.invalidate(user_id)
+        return created
+
+    def create_vpn_configs(self, user_id, configs, server=DEFAULT_SERVER):
+        """
+        Создать пачку конфигов одной транзакцией, без проверки квоты
+
+        Args:
+            configs: [(name, private_key, public_key), ...]
+
+        Returns:
+            list: [{"id", "name", "ip_address"}, ...] в порядке configs
+        """
+        created = []
+        with self.get_connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            cursor = conn.cursor()
+            for name, private_key, public_key in configs:
+                ip_address = self._allocate_ip(cursor, server)
+                cursor.execute(
+                    """
+                    INSERT INTO vpn_configs
+                        (user_id, name, private_key, public_key, ip_address, server)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                    (user_id, name, private_key, public_key, ip_address, server),
+                )
+                created.append({"id": cursor.lastrowid, "name": name, "ip_address": ip_address})
+            self._count_configs(cursor, server, len(created))
+        self._config_lists.invalidate(user_id)
+        return created
+
+    def _quota_usage(self, cursor, user_id):
+        cursor.execute(
+            """
+            SELECT COALESCE(u.config_quota, t.max_configs)
+            FROM users u LEFT JOIN quota_tiers t ON t.name = u.tier
+            WHERE u.user_id = ?
+        """,
+            (user_id,),
+        )
+        row = cursor.fetchone()
+        quota = row[0] if row and row[0] is not None else DEFAULT_CONFIG_QUOTA
+
+        cursor.execute("SELECT COUNT(*) FROM vpn_configs WHERE user_id = ?", (user_id,))
+        return cursor.fetchone()[0], quota
+
+    def get_quota_usage(self, user_id):
+        """
+        Returns:
+            tuple: (число конфигов пользователя, его квота)
+        """
+        with self.get_connection() as conn:
+            return self._quota_usage(conn.cursor(), user_id)
+
+    def set_user_quota(self, user_id, quota=None, tier=None):
+        """
+        Задать пользователю личную квоту или тариф
+
+        Обе колонки перезаписываются: значение, переданное как None,
+        сбрасывается. Поэтому назначение тарифа снимает личную квоту (иначе
+        она, как более приоритетная, перекрыла бы тариф), личная квота снимает
+        тариф, а вызов без quota и tier возвращает DEFAULT_CONFIG_QUOTA.
+
+        Raises:
+            ValueError: тарифа tier нет в quota_tiers
+
+        Returns:
+            bool: False, если пользователя нет
+        """
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            if tier is not None:
+                cursor.execute("SELECT 1 FROM quota_tiers WHERE name = ?", (tier,))
+                if not cursor.fetchone():
+                    raise ValueError(f"Нет тарифа {tier}")
+            cursor.execute(
+                "UPDATE users SET config_quota = ?, tier = ? WHERE user_id = ?",
+                (quota, tier, user_id),
+            )
+            updated = cursor.rowcount > 0
+        self._users.invalidate(user_id)
+        return updated
+
+    def set_quota_tier(self, name, max_configs):
+        """Создать или изменить тариф"""
+        with self.get_connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO quota_tiers (name, max_configs) VALUES (?, ?)",
+                (name, max_configs),
+            )
 
     def get_vpn_config(self, user_id, name):
         with self.get_connection() as conn:
@@ -109,56 +745,500 @@ class Database:
             rows = cursor.fetchall()
             return [dict(row) for row in rows]
 
+    def list_vpn_configs(self, user_id):
+        """
+        Конфиги пользователя без ключей, для списков в интерфейсе
+
+        Результат кешируется, менять возвращённый список нельзя.
+        """
+        configs = self._config_lists.get(user_id)
+        if configs is not None:
+            return configs
+
+        generation = self._config_lists.generation()
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """
+                SELECT id, name, ip_address, server, created_at FROM vpn_configs
+                WHERE user_id = ?
+                ORDER BY created_at DESC
+            """,
+                (user_id,),
+            )
+            configs = [dict(row) for row in cursor.fetchall()]
+
+        self._config_lists.put(user_id, configs, generation)
+        return configs
+
+    def get_vpn_config_by_public_key(self, public_key):
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT * FROM vpn_configs WHERE public_key = ?", (public_key,))
+            row = cursor.fetchone()
+            return dict(row) if row else None
+
     def get_vpn_config_by_id(self, config_id, user_id):
+        """
+        Конфиг вместе с file_id загруженного файла (file_id и file_fingerprint,
+        None, если файл ещё не загружался)
+        """
         with self.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute(
-                "SELECT * FROM vpn_configs WHERE id = ? AND user_id = ?",
+                """
+                SELECT c.*, f.file_id, f.fingerprint AS file_fingerprint
+                FROM vpn_configs c LEFT JOIN config_files f ON f.config_id = c.id
+                WHERE c.id = ? AND c.user_id = ?
+            """,
                 (config_id, user_id),
             )
             row = cursor.fetchone()
             return dict(row) if row else None
 
+    def set_config_file_id(self, config_id, fingerprint, file_id):
+        """Запомнить file_id конфига, загруженного с шаблоном fingerprint"""
+        with self.get_connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO config_files (config_id, fingerprint, file_id) "
+                "VALUES (?, ?, ?)",
+                (config_id, fingerprint, file_id),
+            )
+
     def delete_vpn_config(self, user_id, name):
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT id FROM vpn_configs WHERE user_id = ? AND name = ?", (user_id, name)
+            )
+            row = cursor.fetchone()
+            if not row:
+                return False
+            self._delete_vpn_config(cursor, row["id"])
+        self._config_lists.invalidate(user_id)
+        return True
+
+    def delete_vpn_config_by_id(self, config_id, user_id):
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT id FROM vpn_configs WHERE id = ? AND user_id = ?", (config_id, user_id)
+            )
+            if not cursor.fetchone():
+                return False
+            self._delete_vpn_config(cursor, config_id)
+        self._config_lists.invalidate(user_id)
+        return True
+
+    def _delete_vpn_config(self, cursor, config_id):
+        """Удалить конфиг и вернуть его адрес в пул"""
+        cursor.execute("SELECT ip_address, server FROM vpn_configs WHERE id = ?", (config_id,))
+        row = cursor.fetchone()
+        cursor.execute("DELETE FROM vpn_configs WHERE id = ?", (config_id,))
+        self._count_configs(cursor, row["server"], -1)
+        for table in ("peer_stats", "peer_traffic", "peer_traffic_daily", "config_files"):
+            cursor.execute(f"DELETE FROM {table} WHERE config_id = ?", (config_id,))
+        self._release_ip(cursor, row["ip_address"], row["server"])
+
+    def get_server_loads(self):
+        """Число конфигов на каждом сервере: {server: count}"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT server, configs FROM server_loads")
+            return {server: count for server, count in cursor.fetchall()}
+
+    def get_stats(self):
+        """Общее число пользователей и конфигов"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+
+            cursor.execute("SELECT COUNT(*), COALESCE(SUM(active), 0) FROM users")
+            total_users, active_users = cursor.fetchone()
+
+            cursor.execute("SELECT COUNT(*) FROM vpn_configs")
+            total_configs = cursor.fetchone()[0]
+
+            return {"users": total_users, "active_users": active_users, "configs": total_configs}
+
+    def get_server_peers(self, server):
+        """Пиры, которые должны быть на сервере: {public_key: ip_address}"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT public_key, ip_address FROM vpn_configs WHERE server = ? AND active = 1",
+                (server,),
+            )
+            return dict(cursor.fetchall())
+
+    def deactivate_idle_peers(self, server, public_keys, before):
+        """
+        Пометить неактивными пиры из public_keys, если их включили или создали до before
+
+        После перезапуска интерфейса awg показывает нулевое рукопожатие у
+        всех пиров, поэтому пир с более свежим рукопожатием в peer_stats
+        не снимается.
+
+        Returns:
+            list: ключи пиров, которые нужно снять с интерфейса
+        """
+        deactivated = []
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            for start in range(0, len(public_keys), 500):
+                chunk = public_keys[start : start + 500]
+                cursor.execute(
+                    f"""
+                    SELECT id, public_key FROM vpn_configs
+                    WHERE public_key IN ({", ".join("?" * len(chunk))})
+                        AND server = ? AND active = 1 AND activated_at < ?
+                        AND created_at < datetime(?, 'unixepoch')
+                        AND NOT EXISTS (
+                            SELECT 1 FROM peer_stats s
+                            WHERE s.config_id = vpn_configs.id AND s.last_handshake >= ?
+                        )
+                """,
+                    (*chunk, server, before, before, before),
+                )
+                rows = cursor.fetchall()
+                cursor.executemany(
+                    "UPDATE vpn_configs SET active = 0 WHERE id = ?", ((row["id"],) for row in rows)
+                )
+                deactivated += [row["public_key"] for row in rows]
+        return deactivated
+
+    def activate_vpn_config(self, config_id):
+        """
+        Returns:
+            bool: True, если конфиг был неактивен и пира надо вернуть на сервер
+        """
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "UPDATE vpn_configs SET active = 1, activated_at = ? WHERE id = ? AND active = 0",
+                (int(time.time()), config_id),
+            )
+            return cursor.rowcount == 1
+
+    def record_peer_stats(self, server, live, now, bucket_size):
+        """
+        Записать снимок счётчиков `awg show dump` одного сервера
+
+        Приращение считается от прошлого снимка. Первый снимок пира только
+        запоминается как точка отсчёта: счётчики awg накоплены за всё время
+        жизни интерфейса, и записать их в текущий час значило бы получить
+        выброс после деплоя. Если счётчик уменьшился (интерфейс перезапускали
+        или пира добавили заново), он начался с нуля, и приращением считается
+        всё текущее значение.
+
+        Returns:
+            int: сколько пиров с базой удалось сопоставить
+        """
+        bucket = now // bucket_size * bucket_size
         with self.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 """
-                DELETE FROM vpn_configs
-                WHERE user_id = ? AND name = ?
+                SELECT c.id, c.public_key, s.last_handshake, s.last_rx, s.last_tx,
+                    s.rx_total, s.tx_total
+                FROM vpn_configs c LEFT JOIN peer_stats s ON s.config_id = c.id
+                WHERE c.server = ?
             """,
-                (user_id, name),
+                (server,),
             )
-            conn.commit()
-            return cursor.rowcount > 0
 
-    def delete_vpn_config_by_id(self, config_id, user_id):
+            stats_rows = []
+            traffic_rows = []
+            for row in cursor.fetchall():
+                config_id, public_key, last_handshake, last_rx, last_tx, rx_total, tx_total = row
+                peer = live.get(public_key)
+                if peer is None:
+                    continue
+                rx, tx = peer["rx"], peer["tx"]
+                if last_rx is None:
+                    rx_delta = tx_delta = 0
+                else:
+                    rx_delta = rx - last_rx if rx >= last_rx else rx
+                    tx_delta = tx - last_tx if tx >= last_tx else tx
+                stats_rows.append(
+                    (
+                        config_id,
+                        # после перезапуска интерфейса рукопожатие 0, историю не теряем
+                        max(peer["latest_handshake"], last_handshake or 0),
+                        (rx_total or 0) + rx_delta,
+                        (tx_total or 0) + tx_delta,
+                        rx,
+                        tx,
+                        now,
+                    )
+                )
+                if rx_delta or tx_delta:
+                    traffic_rows.append((config_id, bucket, rx_delta, tx_delta))
+
+            cursor.executemany(
+                """
+                INSERT OR REPLACE INTO peer_stats
+                    (config_id, last_handshake, rx_total, tx_total, last_rx, last_tx, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """,
+                stats_rows,
+            )
+            cursor.executemany(
+                """
+                INSERT INTO peer_traffic (config_id, bucket, rx, tx) VALUES (?, ?, ?, ?)
+                ON CONFLICT(config_id, bucket) DO UPDATE SET
+                    rx = rx + excluded.rx,
+                    tx = tx + excluded.tx
+            """,
+                traffic_rows,
+            )
+            return len(stats_rows)
+
+    def rollup_traffic(self, hourly_before, daily_before):
+        """Свернуть часы старше hourly_before в дни и удалить дни старше daily_before"""
         with self.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute(
-                "DELETE FROM vpn_configs WHERE id = ? AND user_id = ?",
-                (config_id, user_id),
+                """
+                INSERT INTO peer_traffic_daily (config_id, day, rx, tx)
+                SELECT config_id, bucket / 86400 * 86400 AS day, SUM(rx), SUM(tx)
+                FROM peer_traffic WHERE bucket < ?
+                GROUP BY config_id, day
+                ON CONFLICT(config_id, day) DO UPDATE SET
+                    rx = rx + excluded.rx,
+                    tx = tx + excluded.tx
+            """,
+                (hourly_before,),
             )
-            conn.commit()
-            return cursor.rowcount > 0
+            cursor.execute("DELETE FROM peer_traffic WHERE bucket < ?", (hourly_before,))
+            cursor.execute("DELETE FROM peer_traffic_daily WHERE day < ?", (daily_before,))
+
+    def get_peer_stats(self, user_id):
+        """Трафик и последнее рукопожатие конфигов пользователя: {config_id: {...}}"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """
+                SELECT s.config_id, s.last_handshake, s.rx_total, s.tx_total
+                FROM vpn_configs c JOIN peer_stats s ON s.config_id = c.id
+                WHERE c.user_id = ?
+            """,
+                (user_id,),
+            )
+            return {row["config_id"]: dict(row) for row in cursor.fetchall()}
 
-    def get_next_ip(self):
+    def get_traffic_summary(self, since, online_since):
+        """
+        Returns:
+            dict: {"rx", "tx"} за период с since по часовым данным и
+            "online" — число пиров с рукопожатием после online_since
+        """
         with self.get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT ip_address FROM vpn_configs ORDER BY id DESC LIMIT 1")
+            cursor.execute(
+                "SELECT COALESCE(SUM(rx), 0), COALESCE(SUM(tx), 0) FROM peer_traffic "
+                "WHERE bucket >= ?",
+                (since,),
+            )
+            rx, tx = cursor.fetchone()
+            cursor.execute(
+                "SELECT COUNT(*) FROM peer_stats WHERE last_handshake >= ?", (online_since,)
+            )
+            return {"rx": rx, "tx": tx, "online": cursor.fetchone()[0]}
+
+    def add_service_user(self, user_id, first_name):
+        """
+        Завести служебного владельца конфигов, например для /bulk
+
+        Запись нужна ради внешнего ключа vpn_configs; active = 0, чтобы
+        рассылки её пропускали.
+        """
+        with self.get_connection() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO users (user_id, first_name, active) VALUES (?, ?, 0)",
+                (user_id, first_name),
+            )
+        self._users.invalidate(user_id)
+
+    def deactivate_users(self, user_ids):
+        """Пометить пользователей, заблокировавших бота"""
+        with self.get_connection() as conn:
+            conn.executemany(
+                "UPDATE users SET active = 0 WHERE user_id = ?", ((uid,) for uid in user_ids)
+            )
+        for user_id in user_ids:
+            self._users.invalidate(user_id)
+
+    def iter_active_user_ids(self, after=0, limit=500):
+        """
+        Следующая страница активных пользователей после user_id = after
+
+        Курсор по первичному ключу: каждая страница — короткий запрос по
+        индексу, таблица целиком в память не читается.
+        """
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT user_id FROM users WHERE user_id > ? AND active = 1 "
+                "ORDER BY user_id LIMIT ?",
+                (after, limit),
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+    def create_broadcast(self, text):
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("INSERT INTO broadcasts (text) VALUES (?)", (text,))
+            return cursor.lastrowid
+
+    def get_broadcast(self, broadcast_id):
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT * FROM broadcasts WHERE id = ?", (broadcast_id,))
             row = cursor.fetchone()
+            return dict(row) if row else None
 
-            if not row:
-                return "10.0.0.2"
+    def get_running_broadcasts(self):
+        """Рассылки, прерванные остановкой бота"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT * FROM broadcasts WHERE status = 'running' ORDER BY id")
+            return [dict(row) for row in cursor.fetchall()]
+
+    def save_broadcast_progress(self, broadcast_id, last_user_id, sent, failed, blocked):
+        """Сдвинуть курсор рассылки и прибавить счётчики обработанной страницы"""
+        with self.get_connection() as conn:
+            conn.execute(
+                """
+                UPDATE broadcasts SET
+                    last_user_id = ?,
+                    sent = sent + ?,
+                    failed = failed + ?,
+                    blocked = blocked + ?
+                WHERE id = ?
+            """,
+                (last_user_id, sent, failed, blocked, broadcast_id),
+            )
+
+    def finish_broadcast(self, broadcast_id, status="done"):
+        with self.get_connection() as conn:
+            conn.execute(
+                "UPDATE broadcasts SET status = ?, finished_at = CURRENT_TIMESTAMP WHERE id = ?",
+                (status, broadcast_id),
+            )
+
+    def cache_stats(self):
+        """Размер и попадания кешей пользователей и списков конфигов"""
+        return {"users": self._users.stats(), "configs": self._config_lists.stats()}
+
+    def get_fsm(self, key):
+        """Состояние FSM по ключу хранилища"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT state, data, updated_at FROM fsm_states WHERE key = ?", (key,))
+            row = cursor.fetchone()
+            return dict(row) if row else None
+
+    def set_fsm(self, key, state, data, updated_at):
+        """Сохранить состояние FSM, пустое состояние удаляется"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            if state is None and data == "{}":
+                cursor.execute("DELETE FROM fsm_states WHERE key = ?", (key,))
+                return
+            cursor.execute(
+                """
+                INSERT OR REPLACE INTO fsm_states (key, state, data, updated_at)
+                VALUES (?, ?, ?, ?)
+            """,
+                (key, state, data, updated_at),
+            )
+
+    def purge_fsm(self, older_than):
+        """Удалить состояния FSM, не обновлявшиеся с older_than"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM fsm_states WHERE updated_at < ?", (older_than,))
+            return cursor.rowcount
+
+
+class AsyncDatabase:
+    """
+    Асинхронный фасад над Database для хендлеров
+
+    Методы Database вызываются в потоках, чтобы не блокировать event loop.
+    Все записи идут через один поток-писатель (SQLite и так допускает только
+    одного писателя, а очередь потока избавляет от ожидания busy timeout),
+    чтения выполняются в отдельном пуле параллельно с ним.
+    """
+
+    WRITE_METHODS = {
+        "add_user",
+        "add_service_user",
+        "add_vpn_config",
+        "create_vpn_config",
+        "create_vpn_configs",
+        "set_config_file_id",
+        "set_user_quota",
+        "set_quota_tier",
+        "record_peer_stats",
+        "deactivate_idle_peers",
+        "activate_vpn_config",
+        "rollup_traffic",
+        "deactivate_users",
+        "create_broadcast",
+        "save_broadcast_progress",
+        "finish_broadcast",
+        "delete_vpn_config",
+        "delete_vpn_config_by_id",
+        "set_fsm",
+        "purge_fsm",
+    }
+
+    def __init__(self, database):
+        self.db = database
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self._readers = ThreadPoolExecutor(
+            max_workers=max(1, database.pool_size - 1), thread_name_prefix="db-reader"
+        )
+
+    async def run(self, func, *args, write=False, **kwargs):
+        """Выполнить произвольную функцию в потоке чтения или записи"""
+        executor = self._writer if write else self._readers
+        loop = asyncio.get_running_loop()
+        name = getattr(func, "__name__", "run")
+        submitted = time.perf_counter()
+
+        def timed():
+            started = time.perf_counter()
+            DB_WAIT_SECONDS.observe(started - submitted, name)
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                DB_ERRORS.inc(name, type(e).__name__)
+                raise
+            finally:
+                DB_SECONDS.observe(time.perf_counter() - started, name)
+
+        return await loop.run_in_executor(executor, timed)
+
+    def __getattr__(self, name):
+        method = getattr(self.db, name)
+        if not callable(method):
+            return method
+
+        write = name in self.WRITE_METHODS
 
-            last_ip = row["ip_address"]
-            parts = last_ip.split(".")
-            last_octet = int(parts[3]) + 1
+        async def call(*args, **kwargs):
+            return await self.run(method, *args, write=write, **kwargs)
 
-            if last_octet > 254:
-                raise Exception("IP адреса закончились")
+        return call
 
-            return f"10.0.0.{last_octet}"
+    def close(self):
+        """Дождаться запущенных запросов и закрыть соединения"""
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+        self.db.close()
 
 
 db = Database()
+adb = AsyncDatabase(db)
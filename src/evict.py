@@ -0,0 +1,71 @@
+import asyncio
+import logging
+import time
+
+from config import PEER_IDLE_DAYS, PEER_IDLE_INTERVAL
+from server import AwgError
+
+logger = logging.getLogger(__name__)
+
+
+class IdleEvictor:
+    """
+    Снимает с интерфейса пиры, которые давно не подключались
+
+    По одному дампу на сервер выбираются пиры с последним рукопожатием
+    старше idle_days, в базе они помечаются неактивными и удаляются одним
+    батчем через PeerQueue. Рукопожатие из дампа сверяется с сохранённым в
+    peer_stats: после перезагрузки хоста awg показывает 0 у всех пиров.
+    Строка, ключи и IP остаются: при скачивании конфига пир включается
+    обратно. Сверка добавляет на интерфейс только активные пиры, поэтому
+    снятые она не вернёт.
+    """
+
+    def __init__(self, adb, nodes, idle_days=PEER_IDLE_DAYS, interval=PEER_IDLE_INTERVAL):
+        self.adb = adb
+        self.nodes = nodes
+        self.idle_after = idle_days * 86400
+        self.interval = interval
+        self._task = None
+
+    async def evict_node(self, node):
+        """
+        Returns:
+            int: сколько пиров снято
+        """
+        before = int(time.time()) - self.idle_after
+        live = await node.backend.dump(node.interface)
+        stale = [key for key, peer in live.items() if peer["latest_handshake"] < before]
+        if not stale:
+            return 0
+
+        evicted = await self.adb.deactivate_idle_peers(node.name, stale, before)
+        if evicted:
+            await asyncio.gather(*(node.queue.remove(key) for key in evicted))
+            logger.info(f"Сервер {node.name}: снято {len(evicted)} неактивных пиров")
+        return len(evicted)
+
+    async def evict(self):
+        results = {}
+        for node in self.nodes:
+            try:
+                results[node.name] = await self.evict_node(node)
+            except (AwgError, FileNotFoundError) as e:
+                logger.error(f"Снятие неактивных пиров {node.name} не удалось: {e}")
+        return results
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.evict()
+            except Exception as e:
+                logger.error(f"Ошибка снятия неактивных пиров: {e}")
+
+    def start(self):
+        if self.idle_after > 0 and self.interval > 0:
+            self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
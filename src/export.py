@@ -0,0 +1,44 @@
+import io
+import zipfile
+
+try:
+    import qrcode
+except ImportError:
+    qrcode = None
+
+
+def qr_available():
+    """QR коды рисуются, только если установлен необязательный пакет qrcode"""
+    return qrcode is not None
+
+
+def render_qr(config_bytes):
+    """
+    Returns:
+        bytes: PNG с QR кодом конфига для импорта камерой телефона
+    """
+    image = qrcode.make(config_bytes.decode("ascii"))
+    buffer = io.BytesIO()
+    image.save(buffer)
+    return buffer.getvalue()
+
+
+def build_config_archive(configs, with_qr=True):
+    """
+    Собрать zip с .conf (и QR, если доступны) в памяти
+
+    Args:
+        configs: [(file_stem, config_bytes), ...]
+
+    Returns:
+        bytes: содержимое архива
+    """
+    with_qr = with_qr and qr_available()
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+        for stem, config_bytes in configs:
+            archive.writestr(f"{stem}.conf", config_bytes)
+            if with_qr:
+                # PNG уже сжат, повторно его не жмём
+                archive.writestr(f"{stem}.png", render_qr(config_bytes), zipfile.ZIP_STORED)
+    return buffer.getvalue()
@@ -0,0 +1,73 @@
+import asyncio
+import logging
+import signal
+import time
+
+from config import SHUTDOWN_TIMEOUT
+from middlewares import DrainMiddleware
+
+logger = logging.getLogger(__name__)
+
+
+class Lifecycle:
+    """
+    Запуск и плавная остановка бота
+
+    По SIGTERM / SIGINT бот перестаёт быть готовым (/ready отвечает 503) и
+    перестаёт забирать апдейты, затем в пределах timeout дожидается уже
+    принятых хендлеров и применяет накопленные изменения пиров. Закрывать
+    БД и сессию бота вызывающий код должен после drain(), когда новых
+    запросов к ним уже не будет.
+    """
+
+    def __init__(self, timeout=SHUTDOWN_TIMEOUT):
+        self.timeout = timeout
+        self.ready = False
+        self.middleware = DrainMiddleware()
+        self._stopping = None
+
+    @property
+    def stopping(self):
+        # Создаётся лениво, чтобы привязаться к работающему event loop
+        if self._stopping is None:
+            self._stopping = asyncio.Event()
+        return self._stopping
+
+    def install_signal_handlers(self):
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.request_stop, sig)
+
+    def request_stop(self, sig=None):
+        if not self.stopping.is_set():
+            logger.info(f"Получен {signal.Signals(sig).name if sig else 'запрос'}, останавливаемся")
+        self.ready = False
+        self.stopping.set()
+
+    async def run_polling(self, dp, bot):
+        """Polling до запроса остановки; сессию бота не закрывает, она нужна хендлерам"""
+        polling = asyncio.ensure_future(
+            dp.start_polling(bot, handle_signals=False, close_bot_session=False)
+        )
+        stop = asyncio.ensure_future(self.stopping.wait())
+        await asyncio.wait({polling, stop}, return_when=asyncio.FIRST_COMPLETED)
+        if not polling.done():
+            await dp.stop_polling()
+        stop.cancel()
+        await polling
+
+    async def drain(self, nodes):
+        """Дождаться хендлеров и очередей пиров, не дольше timeout в сумме"""
+        self.ready = False
+        deadline = time.monotonic() + self.timeout
+
+        left = await self.middleware.drain(self.timeout)
+        if left:
+            logger.warning(f"Не дождались {left} апдейтов за {self.timeout}с")
+
+        for node in nodes:
+            try:
+                await asyncio.wait_for(node.queue.drain(), max(0.0, deadline - time.monotonic()))
+            except asyncio.TimeoutError:
+                logger.warning(f"Очередь пиров {node.name} не применена до конца")
+        logger.info("Апдейты и очереди пиров обработаны")
@@ -1,56 +1,124 @@
 import asyncio
 import logging
-import os
 import re
+import time
+from datetime import datetime
+import aiohttp
 from aiogram import Bot, Dispatcher, types, F
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest, TelegramForbiddenError
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import (
     ReplyKeyboardMarkup,
     KeyboardButton,
     InlineKeyboardMarkup,
     InlineKeyboardButton,
 )
-from dotenv import load_dotenv
 
-from database import db
-from wireguard import generate_keys, create_client_config
-from server import add_peer_to_server, remove_peer_from_server
-
-load_dotenv()
+from config import (
+    ADMIN_ID,
+    BOT_MODE,
+    BOT_TOKEN,
+    BULK_MAX,
+    BULK_OWNER_ID,
+    METRICS_HOST,
+    METRICS_PORT,
+)
+from broadcast import Broadcaster
+from database import IpPoolExhausted, QuotaExceeded, adb
+from wireguard import config_cache, key_pool
+from server import add_peer_to_server, nodes, remove_peer_from_server
+from evict import IdleEvictor
+from export import build_config_archive, qr_available
+from lifecycle import Lifecycle
+from metrics import start_metrics_server
+from placement import NoCapacity
+from middlewares import (
+    FloodControlMiddleware,
+    MetricsMiddleware,
+    RateLimitMiddleware,
+    TelegramMetricsMiddleware,
+    UserPartitionMiddleware,
+)
+from ratelimit import OutboundLimiter
+from reconcile import Reconciler
+from stats import StatsCollector
+from storage import SQLiteStorage
+from webhook import check_webhook_config, run_webhook
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-bot = Bot(token=os.getenv("BOT_TOKEN"))
-dp = Dispatcher(storage=MemoryStorage())
-
-SERVER_PUBLIC_KEY = os.getenv("WG_SERVER_PUBLIC_KEY")
-SERVER_ENDPOINT = os.getenv("WG_SERVER_ENDPOINT")
-ADMIN_ID = int(os.getenv("ADMIN_ID"))
+bot = Bot(token=BOT_TOKEN)
+dp = Dispatcher(storage=SQLiteStorage(adb))
+reconciler = Reconciler(adb, nodes)
+stats_collector = StatsCollector(adb, nodes)
+idle_evictor = IdleEvictor(adb, nodes)
+broadcaster = Broadcaster(bot, adb)
+lifecycle = Lifecycle()
+
+bot.session.middleware(RateLimitMiddleware(OutboundLimiter()))
+bot.session.middleware(TelegramMetricsMiddleware())
+flood_control = FloodControlMiddleware()
+# Dispatcher регистрирует FSMContextMiddleware в конструкторе, и состояние
+# читалось бы до флуд-контроля и до очереди пользователя, то есть до того,
+# как предыдущий апдейт успел его сменить: переносим его в конец
+dp.update.outer_middleware.unregister(dp.fsm)
+dp.update.outer_middleware(lifecycle.middleware)
+dp.update.outer_middleware(flood_control)
+dp.update.outer_middleware(UserPartitionMiddleware())
+dp.update.outer_middleware(dp.fsm)
+dp.message.middleware(MetricsMiddleware())
+dp.callback_query.middleware(MetricsMiddleware())
 
 NAME_PATTERN = re.compile(r"^[\w\s\-]{1,20}$", re.UNICODE)
 
 
+def format_bytes(size):
+    for unit in ("Б", "КБ", "МБ", "ГБ"):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "Б" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} ТБ"
+
+
+async def ensure_peer_active(config):
+    """Вернуть на сервер пир, снятый за неактивностью"""
+    if config["active"] or not await adb.activate_vpn_config(config["id"]):
+        return
+    success = await add_peer_to_server(config["public_key"], config["ip_address"], config["server"])
+    logger.info(f"Пир конфига {config['id']} включён снова: {success}")
+
+
+async def remember_file_id(config_id, template, sent):
+    """Сохранить file_id отправленного конфига, чтобы не загружать его повторно"""
+    if sent.document is not None:
+        await adb.set_config_file_id(config_id, template.fingerprint, sent.document.file_id)
+
+
 class VpnCreation(StatesGroup):
     waiting_for_name = State()
 
 
+async def delete_message(chat_id, message_id):
+    """Удалить сообщение; уборка чата не должна прерывать хендлер"""
+    try:
+        await bot.delete_message(chat_id, message_id)
+    except (TelegramBadRequest, TelegramForbiddenError) as e:
+        # Уже удалено, старше 48 часов или бот заблокирован — обычное дело
+        logger.debug(f"Не удалось удалить сообщение {message_id}: {e}")
+    except (TelegramAPIError, aiohttp.ClientError) as e:
+        logger.warning(f"Не удалось удалить сообщение {message_id}: {e}")
+
+
 async def delete_previous_messages(message: types.Message, state: FSMContext):
     """Delete user's button message and previous bot response."""
     data = await state.get_data()
     last_msg_id = data.get("last_bot_message_id")
     if last_msg_id:
-        try:
-            await bot.delete_message(message.chat.id, last_msg_id)
-        except Exception:
-            pass
-    try:
-        await message.delete()
-    except Exception:
-        pass
+        await delete_message(message.chat.id, last_msg_id)
+    await delete_message(message.chat.id, message.message_id)
 
 
 def get_main_keyboard():
@@ -87,7 +155,7 @@ async def cmd_start(message: types.Message, state: FSMContext):
     username = message.from_user.username
     first_name = message.from_user.first_name
 
-    db.add_user(user_id, username, first_name)
+    await adb.add_user(user_id, username, first_name)
     logger.info(f"User {user_id} ({username}) started bot")
 
     await message.answer(
@@ -105,11 +173,12 @@ async def get_vpn_start(message: types.Message, state: FSMContext):
     await delete_previous_messages(message, state)
 
     if user_id != ADMIN_ID:
-        configs = db.get_all_vpn_configs(user_id)
-        if len(configs) >= 5:
+        count, quota = await adb.get_quota_usage(user_id)
+        if count >= quota:
             sent = await bot.send_message(
                 message.chat.id,
-                "Вы уже создали максимум конфигов (5). Удалите один из них чтобы создать новый.",
+                f"Вы уже создали максимум конфигов ({quota}). "
+                "Удалите один из них чтобы создать новый.",
             )
             await state.update_data(last_bot_message_id=sent.message_id)
             return
@@ -141,7 +210,7 @@ async def process_vpn_name(message: types.Message, state: FSMContext):
     await state.clear()
     user_id = message.from_user.id
 
-    existing_config = db.get_vpn_config(user_id, name)
+    existing_config = await adb.get_vpn_config(user_id, name)
     if existing_config:
         sent = await bot.send_message(
             message.chat.id,
@@ -155,25 +224,24 @@ async def process_vpn_name(message: types.Message, state: FSMContext):
     await state.update_data(last_bot_message_id=sent.message_id)
 
     try:
-        private_key, public_key = generate_keys()
-        client_ip = db.get_next_ip()
-
-        db.add_vpn_config(user_id, name, private_key, public_key, client_ip)
+        private_key, public_key = await key_pool.get()
+        loads = await adb.get_server_loads()
+        node = nodes.choose(loads)
+        created = await adb.create_vpn_config(
+            user_id, name, private_key, public_key, node.name, enforce_quota=user_id != ADMIN_ID
+        )
+        client_ip = created["ip_address"]
 
-        success = add_peer_to_server(public_key, client_ip)
+        success = await add_peer_to_server(public_key, client_ip, node.name)
         if not success:
-            logger.warning(f"Не удалось связать пользователя с сервером {user_id}")
+            logger.warning(f"Не удалось связать пользователя {user_id} с сервером {node.name}")
 
-        config_text = create_client_config(
-            private_key=private_key,
-            server_public_key=SERVER_PUBLIC_KEY,
-            server_endpoint=SERVER_ENDPOINT,
-            client_ip=client_ip,
-        )
+        config_bytes = node.template.render(private_key, client_ip)
+        config_cache.put(created["id"], config_bytes)
 
         safe_name = re.sub(r"[^\w\-]", "_", name)
         config_file = types.BufferedInputFile(
-            config_text.encode("utf-8"), filename=f"vpn_{safe_name.lower()}.conf"
+            config_bytes, filename=f"vpn_{safe_name.lower()}.conf"
         )
 
         sent = await bot.send_message(
@@ -183,11 +251,19 @@ async def process_vpn_name(message: types.Message, state: FSMContext):
         )
         await state.update_data(last_bot_message_id=sent.message_id)
 
-        await bot.send_document(
+        sent = await bot.send_document(
             message.chat.id, config_file, caption=f"Ваша VPN конфигурация для {name}"
         )
+        await remember_file_id(created["id"], node.template, sent)
 
         logger.info(f"Создан VPN config для user {user_id}, название: {name}, IP: {client_ip}")
+    except QuotaExceeded as e:
+        sent = await bot.send_message(
+            message.chat.id,
+            f"Вы уже создали максимум конфигов ({e.quota}). "
+            "Удалите один из них чтобы создать новый.",
+        )
+        await state.update_data(last_bot_message_id=sent.message_id)
     except Exception as e:
         logger.error(f"Ошибка при создании конфига: {e}")
         sent = await bot.send_message(
@@ -203,7 +279,7 @@ async def manage_vpn(message: types.Message, state: FSMContext):
         await state.clear()
         logger.info(f"User {message.from_user.id} pressed 'Управлять VPN'")
         user_id = message.from_user.id
-        configs = db.get_all_vpn_configs(user_id)
+        configs = await adb.list_vpn_configs(user_id)
 
         if not configs:
             sent = await bot.send_message(
@@ -232,27 +308,48 @@ async def download_config(callback: types.CallbackQuery):
         user_id = callback.from_user.id
         config_id = int(callback.data.replace("download_", ""))
 
-        config = db.get_vpn_config_by_id(config_id, user_id)
+        config = await adb.get_vpn_config_by_id(config_id, user_id)
         if not config:
             await callback.answer("Конфиг не найден", show_alert=True)
             return
 
+        node = nodes.get(config["server"])
+        if node is None:
+            logger.error(f"Конфиг {config_id}: сервер {config['server']} не описан в WG_SERVERS")
+            await callback.answer(
+                "Сервер этого конфига больше не работает. Удалите конфиг и создайте новый.",
+                show_alert=True,
+            )
+            return
+
         name = config["name"]
-        config_text = create_client_config(
-            private_key=config["private_key"],
-            server_public_key=SERVER_PUBLIC_KEY,
-            server_endpoint=SERVER_ENDPOINT,
-            client_ip=config["ip_address"],
-        )
+        caption = f"Конфиг '{name}' (IP: {config['ip_address']})"
+        await ensure_peer_active(config)
+        template = node.template
+
+        # Файл уже загружен в Telegram с теми же параметрами сервера:
+        # отправляем по file_id, без повторной загрузки
+        if config["file_id"] and config["file_fingerprint"] == template.fingerprint:
+            try:
+                await callback.message.answer_document(config["file_id"], caption=caption)
+                await callback.answer()
+                logger.info(f"User {user_id} downloaded config {name} (file_id)")
+                return
+            except TelegramBadRequest as e:
+                logger.warning(f"file_id конфига {config_id} не принят, загружаем заново: {e}")
+
+        config_bytes = config_cache.get(config_id)
+        if config_bytes is None:
+            config_bytes = template.render(config["private_key"], config["ip_address"])
+            config_cache.put(config_id, config_bytes)
 
         safe_name = re.sub(r"[^\w\-]", "_", name)
         config_file = types.BufferedInputFile(
-            config_text.encode("utf-8"), filename=f"vpn_{safe_name.lower()}.conf"
+            config_bytes, filename=f"vpn_{safe_name.lower()}.conf"
         )
 
-        await callback.message.answer_document(
-            config_file, caption=f"Конфиг '{name}' (IP: {config['ip_address']})"
-        )
+        sent = await callback.message.answer_document(config_file, caption=caption)
+        await remember_file_id(config_id, template, sent)
         await callback.answer()
         logger.info(f"User {user_id} downloaded config {name}")
     except Exception as e:
@@ -266,14 +363,19 @@ async def delete_config(callback: types.CallbackQuery):
         user_id = callback.from_user.id
         config_id = int(callback.data.replace("delete_", ""))
 
-        config = db.get_vpn_config_by_id(config_id, user_id)
+        config = await adb.get_vpn_config_by_id(config_id, user_id)
         if not config:
             await callback.answer("Конфиг не найден", show_alert=True)
             return
 
         name = config["name"]
-        success = remove_peer_from_server(config["public_key"])
-        db.delete_vpn_config_by_id(config_id, user_id)
+        # Сначала строка: сверка между двумя шагами иначе увидела бы строку
+        # без пира и вернула его. Пира, которого не удалось снять, снимет она же
+        if not await adb.delete_vpn_config_by_id(config_id, user_id):
+            await callback.answer("Конфиг не найден", show_alert=True)
+            return
+        config_cache.invalidate(config_id)
+        success = await remove_peer_from_server(config["public_key"], config["server"])
 
         logger.info(f"Удален VPN конфиг {user_id}: {name}")
 
@@ -284,7 +386,7 @@ async def delete_config(callback: types.CallbackQuery):
                 "Конфиг удален из базы (ошибка удаления с сервера)", show_alert=True
             )
 
-        configs = db.get_all_vpn_configs(user_id)
+        configs = await adb.list_vpn_configs(user_id)
         if configs:
             config_list = "\n".join(
                 [f"• {cfg['name']} (IP: {cfg['ip_address']})" for cfg in configs]
@@ -308,10 +410,11 @@ async def show_profile(message: types.Message, state: FSMContext):
         logger.info(f"User {message.from_user.id} pressed 'Мой профиль'")
         user_id = message.from_user.id
 
-        db.add_user(user_id, message.from_user.username, message.from_user.first_name)
+        await adb.add_user(user_id, message.from_user.username, message.from_user.first_name)
 
-        user = db.get_user(user_id)
-        configs = db.get_all_vpn_configs(user_id)
+        user = await adb.get_user(user_id)
+        configs = await adb.list_vpn_configs(user_id)
+        peer_stats = await adb.get_peer_stats(user_id)
 
         if not user:
             sent = await bot.send_message(message.chat.id, "Ошибка получения профиля")
@@ -332,6 +435,15 @@ async def show_profile(message: types.Message, state: FSMContext):
             profile_text += "<b>Ваши VPN конфигурации:</b>\n"
             for cfg in configs:
                 profile_text += f"• {cfg['name']} (IP: {cfg['ip_address']})\n"
+                stats = peer_stats.get(cfg["id"])
+                if stats and stats["last_handshake"]:
+                    seen = datetime.fromtimestamp(stats["last_handshake"]).strftime(
+                        "%d.%m.%Y %H:%M"
+                    )
+                    profile_text += (
+                        f"  ↓ {format_bytes(stats['tx_total'])} "
+                        f"↑ {format_bytes(stats['rx_total'])}, был в сети {seen}\n"
+                    )
         else:
             profile_text += "VPN конфигурация не создана\n\n"
             profile_text += "Нажмите 'Получить VPN' чтобы создать"
@@ -404,18 +516,28 @@ async def cmd_stats(message: types.Message):
         if message.from_user.id != ADMIN_ID:
             return
 
-        with db.get_connection() as conn:
-            cursor = conn.cursor()
-
-            cursor.execute("SELECT COUNT(*) FROM users")
-            total_users = cursor.fetchone()[0]
-
-            cursor.execute("SELECT COUNT(*) FROM vpn_configs")
-            total_configs = cursor.fetchone()[0]
+        stats = await adb.get_stats()
 
         stats_text = "<b>Статистика</b>\n\n"
-        stats_text += f"Всего пользователей: {total_users}\n"
-        stats_text += f"VPN конфигураций: {total_configs}"
+        stats_text += f"Всего пользователей: {stats['users']}\n"
+        stats_text += f"Активных (не заблокировали бота): {stats['active_users']}\n"
+        stats_text += f"VPN конфигураций: {stats['configs']}\n\n"
+
+        stats_text += f"Отброшено апдейтов (флуд): {flood_control.dropped}\n"
+
+        now = int(time.time())
+        traffic = await adb.get_traffic_summary(now - 86400, now - 180)
+        stats_text += f"Онлайн (рукопожатие за 3 мин): {traffic['online']}\n"
+        stats_text += (
+            f"Трафик за сутки: ↓ {format_bytes(traffic['tx'])} "
+            f"↑ {format_bytes(traffic['rx'])}\n\n"
+        )
+
+        cache = await adb.cache_stats()
+        for name, title in (("users", "пользователей"), ("configs", "списков конфигов")):
+            hits, misses = cache[name]["hits"], cache[name]["misses"]
+            rate = hits / (hits + misses) * 100 if hits + misses else 0
+            stats_text += f"Кеш {title}: {cache[name]['size']} шт., попаданий {rate:.0f}%\n"
 
         await message.answer(stats_text, parse_mode="HTML")
     except Exception as e:
@@ -423,6 +545,184 @@ async def cmd_stats(message: types.Message):
         await message.answer("Произошла ошибка при получении статистики.")
 
 
+@dp.message(Command("quota"))
+async def cmd_quota(message: types.Message):
+    """/quota <user_id> [число | тариф | reset]"""
+    try:
+        if message.from_user.id != ADMIN_ID:
+            return
+
+        args = message.text.split()[1:]
+        if not args or not args[0].isdigit():
+            await message.answer(
+                "Использование:\n"
+                "/quota &lt;user_id&gt; — текущая квота\n"
+                "/quota &lt;user_id&gt; &lt;число&gt; — личная квота вместо тарифа\n"
+                "/quota &lt;user_id&gt; &lt;тариф&gt; — назначить тариф, личная квота снимается\n"
+                "/quota &lt;user_id&gt; reset — квота по умолчанию",
+                parse_mode="HTML",
+            )
+            return
+
+        user_id = int(args[0])
+        if len(args) > 1:
+            value = args[1]
+            if value == "reset":
+                updated = await adb.set_user_quota(user_id)
+            elif value.isdigit():
+                updated = await adb.set_user_quota(user_id, quota=int(value))
+            else:
+                updated = await adb.set_user_quota(user_id, tier=value)
+            if not updated:
+                await message.answer("Пользователь не найден")
+                return
+            logger.info(f"Квота пользователя {user_id} изменена: {value}")
+
+        count, quota = await adb.get_quota_usage(user_id)
+        await message.answer(f"Пользователь {user_id}: {count} из {quota} конфигов")
+    except ValueError as e:
+        await message.answer(str(e))
+    except Exception as e:
+        logger.error(f"Ошибка в cmd_quota: {e}")
+        await message.answer("Произошла ошибка при изменении квоты.")
+
+
+@dp.message(Command("tier"))
+async def cmd_tier(message: types.Message):
+    """/tier <название> <число> — создать или изменить тариф"""
+    try:
+        if message.from_user.id != ADMIN_ID:
+            return
+
+        args = message.text.split()[1:]
+        if len(args) != 2 or not args[1].isdigit():
+            await message.answer("Использование: /tier <название> <число конфигов>")
+            return
+
+        await adb.set_quota_tier(args[0], int(args[1]))
+        logger.info(f"Тариф {args[0]}: {args[1]} конфигов")
+        await message.answer(f"Тариф {args[0]}: до {args[1]} конфигов")
+    except Exception as e:
+        logger.error(f"Ошибка в cmd_tier: {e}")
+        await message.answer("Произошла ошибка при изменении тарифа.")
+
+
+@dp.message(Command("bulk"))
+async def cmd_bulk(message: types.Message):
+    """/bulk <число> [префикс] — создать пачку конфигов и прислать одним архивом"""
+    try:
+        if message.from_user.id != ADMIN_ID:
+            return
+
+        args = message.text.split()[1:]
+        prefix = args[1] if len(args) > 1 else "team"
+        if not args or not args[0].isdigit() or not 0 < int(args[0]) <= BULK_MAX:
+            await message.answer(f"Использование: /bulk <число до {BULK_MAX}> [префикс]")
+            return
+        count = int(args[0])
+
+        # Отдельный владелец: сотня конфигов не раздувает клавиатуру "Управлять VPN" админа
+        user_id = BULK_OWNER_ID
+        await adb.add_service_user(user_id, "bulk")
+        taken = {cfg["name"] for cfg in await adb.list_vpn_configs(user_id)}
+        names = []
+        number = 1
+        while len(names) < count:
+            name = f"{prefix}-{number}"
+            if name not in taken:
+                names.append(name)
+            number += 1
+        if not all(NAME_PATTERN.match(name) for name in names):
+            await message.answer(
+                "Недопустимый префикс: буквы, цифры, дефис, до 20 символов с номером"
+            )
+            return
+
+        # Место проверяется до генерации ключей: пачка либо создаётся целиком, либо никак
+        loads = await adb.get_server_loads()
+        try:
+            node = nodes.choose(loads, count=count)
+        except NoCapacity:
+            free = max(server.capacity - loads.get(server.name, 0) for server in nodes)
+            await message.answer(
+                f"Нет сервера со свободным местом на {count} конфигов, "
+                f"на самом свободном осталось {max(free, 0)}"
+            )
+            return
+
+        keys = await key_pool.get_many(count)
+        try:
+            created = await adb.create_vpn_configs(
+                user_id, [(name, *pair) for name, pair in zip(names, keys)], node.name
+            )
+        except IpPoolExhausted:
+            await message.answer(
+                f"В подсети сервера {node.name} не хватает адресов на {count} конфигов, "
+                "ничего не создано"
+            )
+            return
+
+        # PeerQueue соберёт все добавления в один вызов awg set и один save
+        results = await asyncio.gather(
+            *(
+                add_peer_to_server(public_key, cfg["ip_address"], node.name)
+                for cfg, (_, public_key) in zip(created, keys)
+            )
+        )
+
+        files = []
+        for cfg, (private_key, _) in zip(created, keys):
+            config_bytes = node.template.render(private_key, cfg["ip_address"])
+            config_cache.put(cfg["id"], config_bytes)
+            files.append((f"vpn_{cfg['name'].lower()}", config_bytes))
+        archive = await asyncio.to_thread(build_config_archive, files)
+
+        caption = f"{count} конфигов на сервере {node.name}"
+        if not qr_available():
+            caption += " (QR не созданы: пакет qrcode не установлен)"
+        if not all(results):
+            caption += f"\nНе добавлено на сервер: {results.count(False)}, исправит сверка"
+        await message.answer_document(
+            types.BufferedInputFile(archive, filename=f"vpn_{prefix.lower()}.zip"),
+            caption=caption,
+        )
+        logger.info(f"Админ создал {count} конфигов {prefix}-* на {node.name}")
+    except Exception as e:
+        logger.error(f"Ошибка в cmd_bulk: {e}")
+        await message.answer("Произошла ошибка при создании конфигов.")
+
+
+@dp.message(Command("broadcast"))
+async def cmd_broadcast(message: types.Message):
+    """/broadcast <текст> — разослать всем, /broadcast stop — остановить"""
+    try:
+        if message.from_user.id != ADMIN_ID:
+            return
+
+        parts = message.text.split(maxsplit=1)
+        text = parts[1].strip() if len(parts) > 1 else ""
+
+        if not text:
+            running = ", ".join(str(i) for i in broadcaster.running) or "нет"
+            await message.answer(
+                f"Использование: /broadcast <текст>\n/broadcast stop — остановить\n\n"
+                f"Идут рассылки: {running}"
+            )
+            return
+
+        if text == "stop":
+            stopped = [i for i in broadcaster.running if await broadcaster.cancel(i)]
+            await message.answer(f"Остановлено рассылок: {len(stopped)}")
+            return
+
+        broadcast_id = await broadcaster.start(text)
+        logger.info(f"Админ запустил рассылку {broadcast_id}")
+        await message.answer(f"Рассылка {broadcast_id} запущена, по завершении придёт отчёт")
+    except Exception as e:
+        logger.error(f"Ошибка в cmd_broadcast: {e}")
+        await message.answer("Произошла ошибка при запуске рассылки.")
+
+
 @dp.callback_query()
 async def unknown_callback_handler(callback: types.CallbackQuery):
     logger.warning(f"Необработанный callback от {callback.from_user.id}: '{callback.data}'")
@@ -437,10 +737,49 @@ async def echo_handler(message: types.Message):
     )
 
 
+@dp.startup()
+async def on_startup():
+    lifecycle.ready = True
+    logger.info("Бот готов принимать апдейты")
+
+
 async def main():
     logger.info("Бот запускается...")
-    logger.info(f"Server endpoint: {SERVER_ENDPOINT}")
-    await dp.start_polling(bot)
+    if BOT_MODE == "webhook":
+        check_webhook_config()
+    lifecycle.install_signal_handlers()
+    for node in nodes:
+        logger.info(f"Сервер {node.name}: {node.endpoint} ({node.interface}, {node.subnet})")
+    key_pool.start()
+    reconciler.start()
+    stats_collector.start()
+    idle_evictor.start()
+    await broadcaster.resume()
+    metrics_runner = None
+    if METRICS_PORT:
+        metrics_runner = await start_metrics_server(
+            METRICS_HOST, METRICS_PORT, ready=lambda: lifecycle.ready
+        )
+    try:
+        if BOT_MODE == "webhook":
+            await run_webhook(dp, bot, lifecycle.stopping)
+        else:
+            await lifecycle.run_polling(dp, bot)
+    finally:
+        lifecycle.ready = False
+        # Порт проб освобождается сразу, чтобы новый экземпляр мог стартовать,
+        # фоновые задачи останавливаются до drain — их подхватит новый экземпляр
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        broadcaster.stop()
+        idle_evictor.stop()
+        stats_collector.stop()
+        reconciler.stop()
+        await lifecycle.drain(nodes)
+        key_pool.close()
+        await bot.session.close()
+        adb.close()
+        logger.info("Бот остановлен")
 
 
 if __name__ == "__main__":
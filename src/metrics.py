@@ -0,0 +1,245 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Границы бакетов гистограмм в секундах: от быстрых запросов к SQLite
+# до вызовов awg и Telegram API под нагрузкой
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs += [f'{name}="{value}"' for name, value in extra]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    """Метрика с метками; значения меняются из любых потоков"""
+
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _check(self, values):
+        if len(values) != len(self.labels):
+            raise ValueError(f"{self.name}: ожидались метки {self.labels}, получено {values}")
+        return tuple(values)
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        with self._lock:
+            items = sorted(self._values.items())
+        for values, sample in items:
+            lines += self._render_sample(values, sample)
+        return lines
+
+    def _render_sample(self, values, sample):
+        return [f"{self.name}{_format_labels(self.labels, values)} {sample}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *values, amount=1):
+        key = self._check(values)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, *values):
+        key = self._check(values)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, *values, amount=1):
+        key = self._check(values)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, *values, amount=1):
+        self.inc(*values, amount=-amount)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, amount, *values):
+        key = self._check(values)
+        with self._lock:
+            sample = self._values.get(key)
+            if sample is None:
+                # счётчики по бакетам (последний — +Inf), сумма
+                sample = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts = sample[0]
+            for i, bound in enumerate(self.buckets):
+                if amount <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-1] += 1
+            sample[1] += amount
+
+    def summary(self):
+        """
+        Returns:
+            dict: {метки: {"count", "sum"}} — для отчётов бенчмарков
+        """
+        with self._lock:
+            return {
+                values: {"count": sum(counts), "sum": total}
+                for values, (counts, total) in self._values.items()
+            }
+
+    @contextmanager
+    def time(self, *values):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *values)
+
+    def _render_sample(self, values, sample):
+        counts, total = sample
+        lines = []
+        cumulative = 0
+        bounds = [str(bound) for bound in self.buckets] + ["+Inf"]
+        for bound, count in zip(bounds, counts):
+            cumulative += count
+            labels = _format_labels(self.labels, values, [("le", bound)])
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labels, values)
+        lines.append(f"{self.name}_sum{labels} {total}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Текстовый формат экспозиции Prometheus"""
+        lines = []
+        for metric in self._metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+UPDATES_IN_FLIGHT = registry.register(
+    Gauge("bot_updates_in_flight", "Апдейты, которые сейчас обрабатываются")
+)
+HANDLER_SECONDS = registry.register(
+    Histogram("bot_handler_seconds", "Время работы хендлера", ["handler"])
+)
+HANDLER_ERRORS = registry.register(
+    Counter("bot_handler_errors_total", "Исключения, вышедшие из хендлера", ["handler", "error"])
+)
+DB_SECONDS = registry.register(
+    Histogram("bot_db_seconds", "Время выполнения метода Database", ["method"])
+)
+DB_WAIT_SECONDS = registry.register(
+    Histogram("bot_db_wait_seconds", "Ожидание свободного потока БД", ["method"])
+)
+DB_ERRORS = registry.register(
+    Counter("bot_db_errors_total", "Исключения в методах Database", ["method", "error"])
+)
+AWG_SECONDS = registry.register(
+    Histogram("bot_awg_seconds", "Время выполнения awg / awg-quick", ["command"])
+)
+AWG_ERRORS = registry.register(
+    Counter("bot_awg_errors_total", "Ошибки и таймауты awg / awg-quick", ["command"])
+)
+TELEGRAM_SECONDS = registry.register(
+    Histogram("bot_telegram_seconds", "Время запроса к Telegram Bot API", ["method"])
+)
+TELEGRAM_ERRORS = registry.register(
+    Counter("bot_telegram_errors_total", "Ошибки запросов к Telegram", ["method", "error"])
+)
+TELEGRAM_THROTTLE_SECONDS = registry.register(
+    Histogram("bot_telegram_throttle_seconds", "Ожидание лимита исходящих запросов", ["priority"])
+)
+TELEGRAM_RETRY_AFTER = registry.register(
+    Counter("bot_telegram_retry_after_total", "Ответы 429 от Telegram", ["method"])
+)
+
+UPDATE_PARTITIONS = registry.register(
+    Gauge("bot_update_partitions", "Пользователи, у которых есть апдейты в работе или очереди")
+)
+UPDATE_PARTITION_DEPTH = registry.register(
+    Histogram(
+        "bot_update_partition_depth",
+        "Глубина очереди пользователя в момент прихода апдейта",
+        buckets=(1, 2, 3, 5, 10, 20, 50),
+    )
+)
+UPDATE_WAIT_SECONDS = registry.register(
+    Histogram("bot_update_wait_seconds", "Ожидание апдейта до запуска хендлеров", ["stage"])
+)
+UPDATES_DROPPED = registry.register(
+    Counter("bot_updates_dropped_total", "Отброшенные апдейты", ["reason"])
+)
+
+
+async def _metrics_handler(request):
+    return web.Response(text=registry.render(), content_type="text/plain", charset="utf-8")
+
+
+async def start_metrics_server(host, port, ready=None):
+    """
+    Поднять HTTP сервер с /metrics и пробами /health и /ready
+
+    Args:
+        ready: функция без аргументов; /ready отвечает 200, пока она
+            возвращает True, иначе 503
+
+    Returns:
+        web.AppRunner: остановить через `await runner.cleanup()`
+    """
+
+    async def ready_handler(request):
+        if ready is None or ready():
+            return web.Response(text="ok\n")
+        return web.Response(status=503, text="not ready\n")
+
+    async def health_handler(request):
+        return web.Response(text="ok\n")
+
+    app = web.Application()
+    app.router.add_get("/metrics", _metrics_handler)
+    app.router.add_get("/ready", ready_handler)
+    app.router.add_get("/health", health_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Метрики доступны на http://{host}:{port}/metrics")
+    return runner
@@ -0,0 +1,325 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramAPIError, TelegramRetryAfter
+
+from config import (
+    ADMIN_ID,
+    FLOOD_BURST,
+    FLOOD_RATE,
+    FLOOD_WINDOW,
+    FLOOD_WINDOW_MAX,
+    TG_MAX_RETRIES,
+    UPDATE_CONCURRENCY,
+    USER_QUEUE_MAX,
+)
+from metrics import (
+    HANDLER_ERRORS,
+    HANDLER_SECONDS,
+    TELEGRAM_ERRORS,
+    TELEGRAM_RETRY_AFTER,
+    TELEGRAM_SECONDS,
+    TELEGRAM_THROTTLE_SECONDS,
+    UPDATE_PARTITION_DEPTH,
+    UPDATE_PARTITIONS,
+    UPDATE_WAIT_SECONDS,
+    UPDATES_DROPPED,
+    UPDATES_IN_FLIGHT,
+)
+from ratelimit import TokenBucket, is_background
+
+logger = logging.getLogger(__name__)
+
+# Сколько пользователей помнит защита от флуда, давно молчавшие вытесняются
+FLOOD_TRACKED_USERS = 50000
+FLOOD_WARNING = "Слишком много запросов, подождите немного"
+
+# Методы, на которые у Telegram действуют лимиты на отправку
+LIMITED_METHOD_PREFIXES = ("Send", "Copy", "Forward", "Edit")
+
+
+class DrainMiddleware(BaseMiddleware):
+    """
+    Учёт апдейтов в работе для остановки бота
+
+    Регистрируется на `dp.update` первым из наших outer middleware: раньше
+    него отрабатывают только встроенные в aiogram ErrorsMiddleware и
+    UserContextMiddleware, которые не ждут ни БД, ни очередей. После drain()
+    новые апдейты не принимаются, а drain ждёт завершения уже принятых,
+    включая стоящие в очереди пользователя.
+    """
+
+    def __init__(self):
+        self.accepting = True
+        self._tasks = set()
+
+    async def __call__(self, handler, event, data):
+        if not self.accepting:
+            UPDATES_DROPPED.inc("shutdown")
+            logger.warning(f"Апдейт {event.update_id} пришёл во время остановки, пропускаем")
+            return None
+
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        try:
+            return await handler(event, data)
+        finally:
+            self._tasks.discard(task)
+
+    async def drain(self, timeout):
+        """
+        Returns:
+            int: сколько апдейтов не успело обработаться за timeout
+        """
+        self.accepting = False
+        if not self._tasks:
+            return 0
+        logger.info(f"Ждём обработки {len(self._tasks)} апдейтов...")
+        _, pending = await asyncio.wait(set(self._tasks), timeout=timeout)
+        return len(pending)
+
+
+class FloodState:
+    """Лимиты одного пользователя: корзина токенов и счётчик скользящего окна"""
+
+    def __init__(self, rate, burst):
+        self.bucket = TokenBucket(rate, burst)
+        self.window_start = 0.0
+        self.current = 0
+        self.previous = 0
+        self.warned = False
+
+
+class FloodControlMiddleware(BaseMiddleware):
+    """
+    Отбрасывает апдейты пользователя, который шлёт их слишком часто
+
+    Регистрируется как outer middleware на `dp.update` до очереди
+    пользователя, хендлеров и FSMContextMiddleware (main.py перерегистрирует
+    его после флуд-контроля), поэтому отброшенный апдейт не делает запросов
+    к БД. Корзина токенов (rate в секунду, всплеск burst) режет частые
+    нажатия, скользящее окно (не больше window_max апдейтов за window
+    секунд, оценка по двум соседним окнам) — долгий умеренный спам. Об
+    отброшенных апдейтах пользователь узнаёт одним сообщением за окно, а
+    на каждое отброшенное нажатие inline кнопки отвечается answerCallbackQuery,
+    иначе кнопка крутит индикатор загрузки. ADMIN_ID не ограничивается.
+    """
+
+    def __init__(
+        self,
+        rate=FLOOD_RATE,
+        burst=FLOOD_BURST,
+        window=FLOOD_WINDOW,
+        window_max=FLOOD_WINDOW_MAX,
+        exempt=(ADMIN_ID,),
+    ):
+        self.rate = rate
+        self.burst = burst
+        self.window = window
+        self.window_max = window_max
+        self.exempt = set(exempt)
+        self.dropped = 0
+        self._users = OrderedDict()
+
+    def _state(self, user_id):
+        state = self._users.get(user_id)
+        if state is None:
+            state = self._users[user_id] = FloodState(self.rate, self.burst)
+            if len(self._users) > FLOOD_TRACKED_USERS:
+                self._users.popitem(last=False)
+        else:
+            self._users.move_to_end(user_id)
+        return state
+
+    def _window_count(self, state, now):
+        elapsed = now - state.window_start
+        if elapsed >= self.window:
+            state.previous = state.current if elapsed < 2 * self.window else 0
+            state.current = 0
+            state.window_start = now - elapsed % self.window
+            state.warned = False
+            elapsed = now - state.window_start
+        weight = 1 - elapsed / self.window
+        return state.previous * weight + state.current
+
+    def check(self, user_id, now=None):
+        """
+        Returns:
+            str: None, если апдейт можно обрабатывать, иначе причина отказа
+        """
+        now = time.monotonic() if now is None else now
+        state = self._state(user_id)
+        if self._window_count(state, now) >= self.window_max:
+            return "flood_window"
+        if state.bucket.delay(now):
+            return "flood_rate"
+        state.bucket.reserve(now)
+        state.current += 1
+        return None
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is None or user.id in self.exempt:
+            return await handler(event, data)
+
+        reason = self.check(user.id)
+        if reason is None:
+            return await handler(event, data)
+
+        self.dropped += 1
+        UPDATES_DROPPED.inc(reason)
+        state = self._users[user.id]
+        warn = not state.warned
+        if warn:
+            state.warned = True
+            logger.warning(f"Пользователь {user.id} флудит ({reason}), апдейты отбрасываются")
+
+        bot = data["bot"]
+        chat = data.get("event_chat")
+        try:
+            if event.callback_query is not None:
+                await bot.answer_callback_query(
+                    event.callback_query.id, text=FLOOD_WARNING if warn else None
+                )
+            elif warn and chat is not None:
+                await bot.send_message(chat.id, FLOOD_WARNING)
+        except TelegramAPIError as e:
+            logger.debug(f"Ответ на отброшенный апдейт не отправлен: {e}")
+        return None
+
+
+class UserPartitionMiddleware(BaseMiddleware):
+    """
+    Апдейты одного пользователя по очереди, разных — параллельно
+
+    Регистрируется как outer middleware на `dp.update` перед
+    FSMContextMiddleware, чтобы состояние читалось уже после очереди. У каждого
+    пользователя своя очередь (FIFO asyncio.Lock), поэтому второе нажатие
+    кнопки ждёт, пока отработает первое. Общий семафор ограничивает число
+    одновременно работающих хендлеров, слот берётся только после своей
+    очереди: всплеск от одного пользователя не занимает слоты остальных.
+    Если у пользователя уже max_queue апдейтов, новые отбрасываются.
+    """
+
+    def __init__(self, concurrency=UPDATE_CONCURRENCY, max_queue=USER_QUEUE_MAX):
+        self.max_queue = max_queue
+        self._concurrency = concurrency
+        self._semaphore = None
+        # user_id -> [lock, апдейтов в работе и в очереди]
+        self._partitions = {}
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is None:
+            return await self._run(handler, event, data)
+
+        partition = self._partitions.get(user.id)
+        if partition is None:
+            partition = self._partitions[user.id] = [asyncio.Lock(), 0]
+            UPDATE_PARTITIONS.set(len(self._partitions))
+        if partition[1] >= self.max_queue:
+            UPDATES_DROPPED.inc("partition_full")
+            logger.warning(f"Пользователь {user.id}: в очереди {partition[1]} апдейтов, пропускаем")
+            return None
+
+        partition[1] += 1
+        UPDATE_PARTITION_DEPTH.observe(partition[1])
+        started = time.perf_counter()
+        try:
+            async with partition[0]:
+                UPDATE_WAIT_SECONDS.observe(time.perf_counter() - started, "user")
+                return await self._run(handler, event, data)
+        finally:
+            partition[1] -= 1
+            if not partition[1]:
+                del self._partitions[user.id]
+                UPDATE_PARTITIONS.set(len(self._partitions))
+
+    async def _run(self, handler, event, data):
+        # Семафор создаётся лениво, чтобы привязаться к работающему event loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._concurrency)
+        started = time.perf_counter()
+        async with self._semaphore:
+            UPDATE_WAIT_SECONDS.observe(time.perf_counter() - started, "global")
+            return await handler(event, data)
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """
+    Время работы и ошибки хендлеров
+
+    Регистрируется как inner middleware роутера (`dp.message.middleware`),
+    там уже известен выбранный хендлер, и метка — имя его функции.
+    """
+
+    async def __call__(self, handler, event, data):
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object else "unknown"
+
+        UPDATES_IN_FLIGHT.inc()
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            HANDLER_ERRORS.inc(name, type(e).__name__)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, name)
+            UPDATES_IN_FLIGHT.dec()
+
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    """Время запросов к Bot API по методам, подключается через `bot.session.middleware`"""
+
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            TELEGRAM_ERRORS.inc(name, type(e).__name__)
+            raise
+        finally:
+            TELEGRAM_SECONDS.observe(time.perf_counter() - started, name)
+
+
+class RateLimitMiddleware(BaseRequestMiddleware):
+    """
+    Лимиты исходящих запросов и повтор после 429
+
+    Подключается через `bot.session.middleware` раньше метрик, чтобы
+    ожидание лимита не попадало во время запроса к API. На retry_after
+    лимитер притормаживается целиком, запрос повторяется до TG_MAX_RETRIES раз.
+    """
+
+    def __init__(self, limiter, max_retries=TG_MAX_RETRIES):
+        self.limiter = limiter
+        self.max_retries = max_retries
+
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        limited = name.startswith(LIMITED_METHOD_PREFIXES)
+        chat_id = getattr(method, "chat_id", None)
+        background = is_background()
+
+        for attempt in range(self.max_retries + 1):
+            if limited:
+                waited = await self.limiter.acquire(chat_id, background)
+                TELEGRAM_THROTTLE_SECONDS.observe(
+                    waited, "background" if background else "foreground"
+                )
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                TELEGRAM_RETRY_AFTER.inc(name)
+                if attempt == self.max_retries:
+                    raise
+                logger.warning(f"{name} в чат {chat_id}: 429, повтор через {e.retry_after}с")
+                self.limiter.pause(e.retry_after, chat_id)
+                if not limited:
+                    await asyncio.sleep(e.retry_after)
@@ -0,0 +1,73 @@
+import itertools
+from abc import ABC, abstractmethod
+
+
+class NoCapacity(Exception):
+    """На всех серверах закончилось место"""
+
+
+class PlacementStrategy(ABC):
+    """
+    Выбор сервера для нового пира
+
+    loads — число конфигов на каждом сервере ({name: count}). Серверы, на
+    которых до capacity не осталось места на count конфигов, не рассматриваются.
+    """
+
+    def choose(self, nodes, loads, region=None, count=1):
+        candidates = [node for node in nodes if loads.get(node.name, 0) + count <= node.capacity]
+        if not candidates:
+            raise NoCapacity("Все серверы заполнены")
+        return self._pick(candidates, loads, region)
+
+    @abstractmethod
+    def _pick(self, candidates, loads, region):
+        pass
+
+
+class LeastLoaded(PlacementStrategy):
+    """Сервер с наименьшей долей занятых мест"""
+
+    def _pick(self, candidates, loads, region):
+        return min(candidates, key=lambda node: loads.get(node.name, 0) / node.capacity)
+
+
+class RoundRobin(PlacementStrategy):
+    """Серверы по кругу"""
+
+    def __init__(self):
+        self._counter = itertools.count()
+
+    def _pick(self, candidates, loads, region):
+        return candidates[next(self._counter) % len(candidates)]
+
+
+class RegionPlacement(LeastLoaded):
+    """
+    Наименее загруженный сервер в регионе пользователя
+
+    Регион берётся из подсказки region, иначе из PLACEMENT_REGION. Язык
+    клиента Telegram подсказкой не служит: он говорит о языке интерфейса,
+    а не о том, где находится пользователь. Если в регионе нет свободных
+    серверов — любой.
+    """
+
+    def __init__(self, default_region=None):
+        self.default_region = default_region
+
+    def _pick(self, candidates, loads, region):
+        for wanted in (region, self.default_region):
+            in_region = [node for node in candidates if wanted and node.region == wanted]
+            if in_region:
+                return super()._pick(in_region, loads, region)
+        return super()._pick(candidates, loads, region)
+
+
+def make_placement(name, default_region=None):
+    if name == "least_loaded":
+        return LeastLoaded()
+    if name == "round_robin":
+        return RoundRobin()
+    if name == "region":
+        return RegionPlacement(default_region)
+    raise ValueError(f"Неизвестная стратегия размещения: {name}")
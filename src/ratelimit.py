@@ -0,0 +1,144 @@
+import asyncio
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from config import (
+    TG_BACKGROUND_SHARE,
+    TG_CHAT_BURST,
+    TG_CHAT_RATE,
+    TG_GLOBAL_BURST,
+    TG_GLOBAL_RATE,
+)
+
+# Сколько per-chat корзин держать в памяти; давно молчавшие чаты вытесняются
+CHAT_BUCKETS_SIZE = 10000
+
+_background = ContextVar("outbound_background", default=False)
+
+
+@contextmanager
+def background_sends():
+    """
+    Запросы к Telegram внутри блока (и в созданных из него задачах) идут
+    фоновым приоритетом: рассылки и прочее, чего пользователь не ждёт
+    """
+    token = _background.set(True)
+    try:
+        yield
+    finally:
+        _background.reset(token)
+
+
+def is_background():
+    return _background.get()
+
+
+class TokenBucket:
+    """
+    Корзина токенов в виде GCRA: хранится только теоретическое время
+    следующей отправки, reserve сразу говорит, сколько ждать
+    """
+
+    def __init__(self, rate, burst=1):
+        self.interval = 1 / rate
+        self.burst_window = (burst - 1) * self.interval
+        self._tat = 0.0
+
+    def delay(self, now):
+        """Сколько ждать до свободного токена, ничего не занимая"""
+        return max(0.0, max(self._tat, now) - now - self.burst_window)
+
+    def reserve(self, now):
+        """Занять токен и вернуть, сколько ждать до отправки"""
+        tat = max(self._tat, now)
+        self._tat = tat + self.interval
+        return max(0.0, tat - now - self.burst_window)
+
+    def pause(self, now, seconds):
+        """Не выдавать токены seconds секунд (ответ 429 с retry_after)"""
+        self._tat = max(self._tat, now + seconds + self.burst_window)
+
+    def idle(self, now):
+        return self._tat <= now
+
+
+class OutboundLimiter:
+    """
+    Лимиты исходящих запросов к Bot API: общий на бота и на каждый чат
+
+    Ответы пользователям занимают общий токен сразу и ждут своей очереди.
+    Фоновые запросы идут по одному, не чаще background_share от общего
+    лимита, и берут общий токен только когда он свободен прямо сейчас,
+    поэтому ответы пользователям никогда не стоят за рассылкой.
+    """
+
+    def __init__(
+        self,
+        rate=TG_GLOBAL_RATE,
+        burst=TG_GLOBAL_BURST,
+        chat_rate=TG_CHAT_RATE,
+        chat_burst=TG_CHAT_BURST,
+        background_share=TG_BACKGROUND_SHARE,
+    ):
+        self._global = TokenBucket(rate, burst)
+        self._background = TokenBucket(rate * background_share)
+        self._background_lock = None
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._chats = OrderedDict()
+
+    def _chat_bucket(self, chat_id, now):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            if len(self._chats) > CHAT_BUCKETS_SIZE:
+                oldest_id, oldest = next(iter(self._chats.items()))
+                if oldest.idle(now):
+                    del self._chats[oldest_id]
+        else:
+            self._chats.move_to_end(chat_id)
+        return bucket
+
+    async def acquire(self, chat_id=None, background=False):
+        """
+        Дождаться права на отправку
+
+        Returns:
+            float: сколько секунд пришлось ждать
+        """
+        started = time.monotonic()
+        if chat_id is not None:
+            delay = self._chat_bucket(chat_id, started).reserve(started)
+            if delay:
+                await asyncio.sleep(delay)
+
+        if not background:
+            delay = self._global.reserve(time.monotonic())
+            if delay:
+                await asyncio.sleep(delay)
+            return time.monotonic() - started
+
+        # Лок создаётся лениво, чтобы привязаться к работающему event loop
+        if self._background_lock is None:
+            self._background_lock = asyncio.Lock()
+        async with self._background_lock:
+            delay = self._background.reserve(time.monotonic())
+            if delay:
+                await asyncio.sleep(delay)
+            while True:
+                now = time.monotonic()
+                delay = self._global.delay(now)
+                if not delay:
+                    self._global.reserve(now)
+                    break
+                await asyncio.sleep(max(delay, self._global.interval))
+        return time.monotonic() - started
+
+    def pause(self, seconds, chat_id=None):
+        """Telegram ответил 429: притормозить общий лимит и чат"""
+        now = time.monotonic()
+        self._global.pause(now, seconds)
+        if chat_id is not None:
+            self._chat_bucket(chat_id, now).pause(now, seconds)
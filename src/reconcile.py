@@ -0,0 +1,93 @@
+import asyncio
+import logging
+
+from config import AWG_BATCH_MAX, RECONCILE_INTERVAL
+from server import AwgError
+
+logger = logging.getLogger(__name__)
+
+
+class Reconciler:
+    """
+    Сверка vpn_configs с живыми интерфейсами AmneziaWG
+
+    За один проход по серверу читает `awg show <iface> dump`, сравнивает
+    множество пиров с базой и применяет только разницу: лишних пиров удаляет,
+    недостающих добавляет, пирам с чужим адресом выставляет правильный.
+    Изменения применяются пачками по AWG_BATCH_MAX, конфиг сохраняется один
+    раз на сервер.
+    """
+
+    def __init__(self, adb, nodes, interval=RECONCILE_INTERVAL):
+        self.adb = adb
+        self.nodes = nodes
+        self.interval = interval
+        self._task = None
+
+    async def reconcile_node(self, node):
+        """
+        Returns:
+            dict: {"added": n, "removed": n}
+        """
+        # Пока держим блокировку очереди, она не применяет батчи. База
+        # читается после дампа: пир на интерфейсе означает, что его строка
+        # уже закоммичена, и живого пира не удалим как лишнего
+        async with node.queue.lock:
+            live = await node.backend.dump(node.interface)
+            wanted = await self.adb.get_server_peers(node.name)
+
+            removed = live.keys() - wanted.keys()
+            added = [
+                key
+                for key, ip_address in wanted.items()
+                if key not in live or live[key]["allowed_ips"] != f"{ip_address}/32"
+            ]
+            if not removed and not added:
+                return {"added": 0, "removed": 0}
+
+            changes = [(key, None) for key in removed]
+            changes += [(key, wanted[key]) for key in added]
+            for start in range(0, len(changes), AWG_BATCH_MAX):
+                await node.backend.set_peers(node.interface, changes[start : start + AWG_BATCH_MAX])
+            await node.backend.save(node.interface)
+
+        logger.info(
+            f"Сверка {node.name}: добавлено {len(added)}, удалено {len(removed)} "
+            f"(в базе {len(wanted)}, на интерфейсе было {len(live)})"
+        )
+        return {"added": len(added), "removed": len(removed)}
+
+    async def reconcile(self):
+        """Сверить все серверы, ошибка одного не мешает остальным"""
+        results = {}
+        known = {node.name for node in self.nodes}
+        for server, count in (await self.adb.get_server_loads()).items():
+            if count and server not in known:
+                logger.warning(f"Сервер {server} не описан в WG_SERVERS, на нём {count} конфигов")
+        for node in self.nodes:
+            try:
+                results[node.name] = await self.reconcile_node(node)
+            except (AwgError, FileNotFoundError) as e:
+                logger.error(f"Сверка {node.name} не удалась: {e}")
+            except Exception as e:
+                # база занята, битая строка дампа и т.п. — следующий проход повторит
+                logger.error(f"Ошибка сверки {node.name}: {e}")
+        return results
+
+    async def _run(self):
+        while True:
+            try:
+                await self.reconcile()
+            except Exception as e:
+                logger.error(f"Ошибка сверки: {e}")
+            if self.interval <= 0:
+                return
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        """Сверить сразу и дальше по расписанию, вызывать из работающего event loop"""
+        self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
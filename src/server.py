@@ -1,46 +1,425 @@
-import subprocess
+import asyncio
+import ipaddress
 import logging
+import shlex
+from abc import ABC, abstractmethod
+
+from config import (
+    AWG_BATCH_MAX,
+    AWG_BATCH_WINDOW,
+    AWG_CONCURRENCY,
+    AWG_TIMEOUT,
+    DEFAULT_SERVER,
+    PLACEMENT_REGION,
+    PLACEMENT_STRATEGY,
+    SSH_CONNECT_TIMEOUT,
+    WG_INTERFACE,
+    WG_SERVERS,
+)
+from metrics import AWG_ERRORS, AWG_SECONDS
+from placement import make_placement
+from wireguard import ConfigTemplate
 
 logger = logging.getLogger(__name__)
 
+_semaphore = None
+
+
+class AwgError(Exception):
+    """Ошибка выполнения awg / awg-quick"""
+
+
+def _get_semaphore():
+    # Создаётся лениво, чтобы семафор привязался к работающему event loop
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(AWG_CONCURRENCY)
+    return _semaphore
+
 
-def add_peer_to_server(public_key, allowed_ip):
+async def run_awg(*args, timeout=AWG_TIMEOUT, command=None):
     """
-    Добавить пира на AmneziaWG сервер
+    Запустить awg / awg-quick без блокировки event loop
+
+    Одновременно выполняется не больше AWG_CONCURRENCY процессов,
+    зависший процесс убивается по таймауту. command — метка для метрик,
+    по умолчанию первые два аргумента (`awg set`, `awg-quick save`).
+
+    Returns:
+        str: stdout команды
     """
-    try:
-        cmd = ["awg", "set", "wg0", "peer", public_key, "allowed-ips", f"{allowed_ip}/32"]
+    command = command or " ".join(args[:2])
+    async with _get_semaphore():
+        with AWG_SECONDS.time(command):
+            proc = await asyncio.create_subprocess_exec(
+                *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+            )
+            try:
+                stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout)
+            except asyncio.TimeoutError:
+                proc.kill()
+                await proc.wait()
+                AWG_ERRORS.inc(command)
+                raise AwgError(f"{command}: таймаут {timeout}с")
 
-        subprocess.run(cmd, capture_output=True, text=True, check=True)
-        logger.info(f"Добавлен пир {public_key[:8]}... с IP {allowed_ip}/32")
+    if proc.returncode != 0:
+        AWG_ERRORS.inc(command)
+        raise AwgError(stderr.decode("utf-8", "replace").strip())
+    return stdout.decode("utf-8", "replace")
 
-        subprocess.run(["awg-quick", "save", "wg0"], check=True)
 
-        return True
-    except subprocess.CalledProcessError as e:
-        logger.error(f"Ошибка с добавлением: {e.stderr}")
-        return False
-    except FileNotFoundError:
-        logger.warning("AmneziaWG не детектится")
-        return False
+def parse_dump(output):
+    """
+    Разобрать вывод `awg show <iface> dump`
 
+    Первая строка описывает сам интерфейс, остальные — пиров.
 
-def remove_peer_from_server(public_key):
+    Returns:
+        dict: {public_key: {"allowed_ips", "latest_handshake", "rx", "tx"}}
     """
-    Удалить пира с AmneziaWG сервера
+    peers = {}
+    for line in output.splitlines()[1:]:
+        fields = line.split("\t")
+        if len(fields) < 8:
+            continue
+        peers[fields[0]] = {
+            "allowed_ips": fields[3],
+            "latest_handshake": int(fields[4]),
+            "rx": int(fields[5]),
+            "tx": int(fields[6]),
+        }
+    return peers
+
+
+def _set_args(interface, peers):
+    args = ["awg", "set", interface]
+    for public_key, allowed_ip in peers:
+        args += ["peer", public_key]
+        args += ["remove"] if allowed_ip is None else ["allowed-ips", f"{allowed_ip}/32"]
+    return args
+
+
+class PeerBackend(ABC):
+    """
+    Способ применить изменения пиров к интерфейсу узла
+
+    peers — список (public_key, allowed_ip), allowed_ip=None означает удаление.
+    """
+
+    @abstractmethod
+    async def set_peers(self, interface, peers):
+        pass
+
+    @abstractmethod
+    async def save(self, interface):
+        pass
+
+    @abstractmethod
+    async def dump(self, interface):
+        """Текущие пиры интерфейса в формате parse_dump"""
+
+
+class LocalAwgBackend(PeerBackend):
+    """awg на том же хосте, что и бот"""
+
+    async def set_peers(self, interface, peers):
+        await run_awg(*_set_args(interface, peers))
+
+    async def save(self, interface):
+        await run_awg("awg-quick", "save", interface)
+
+    async def dump(self, interface):
+        return parse_dump(await run_awg("awg", "show", interface, "dump"))
+
+
+class SshAwgBackend(PeerBackend):
+    """
+    awg на удалённом хосте через ssh (нужен доступ по ключу)
+
+    BatchMode запрещает ssh спрашивать пароль или подтверждение ключа хоста:
+    без терминала такой вызов висел бы до AWG_TIMEOUT, занимая слот
+    AWG_CONCURRENCY. Ключ хоста должен заранее быть в known_hosts.
+    """
+
+    def __init__(self, host, connect_timeout=SSH_CONNECT_TIMEOUT):
+        self.host = host
+        self.options = ["-o", "BatchMode=yes", "-o", f"ConnectTimeout={connect_timeout}"]
+
+    async def _run(self, args):
+        return await run_awg(
+            "ssh", *self.options, self.host, shlex.join(args), command=" ".join(args[:2])
+        )
+
+    async def set_peers(self, interface, peers):
+        await self._run(_set_args(interface, peers))
+
+    async def save(self, interface):
+        await self._run(["awg-quick", "save", interface])
+
+    async def dump(self, interface):
+        return parse_dump(await self._run(["awg", "show", interface, "dump"]))
+
+
+class FakePeerBackend(PeerBackend):
+    """Пиры в памяти процесса, для тестов и разработки без AmneziaWG"""
+
+    def __init__(self):
+        self.interfaces = {}
+        self.saves = 0
+
+    async def set_peers(self, interface, peers):
+        table = self.interfaces.setdefault(interface, {})
+        for public_key, allowed_ip in peers:
+            if allowed_ip is None:
+                table.pop(public_key, None)
+                continue
+            peer = table.setdefault(public_key, {"latest_handshake": 0, "rx": 0, "tx": 0})
+            peer["allowed_ips"] = f"{allowed_ip}/32"
+
+    async def save(self, interface):
+        self.saves += 1
+
+    async def dump(self, interface):
+        return {key: dict(peer) for key, peer in self.interfaces.get(interface, {}).items()}
+
+
+class PeerQueue:
     """
-    try:
-        cmd = ["awg", "set", "wg0", "peer", public_key, "remove"]
+    Очередь изменений пиров интерфейса
+
+    Добавления и удаления копятся в течение AWG_BATCH_WINDOW и применяются
+    вызовами `awg set` с несколькими peer-секциями, не больше AWG_BATCH_MAX
+    в каждом, после чего конфиг сохраняется один раз через `awg-quick save`.
+    Несколько изменений одного ключа в пределах окна схлопываются в последнее.
+    """
+
+    def __init__(
+        self, backend, interface=WG_INTERFACE, window=AWG_BATCH_WINDOW, max_batch=AWG_BATCH_MAX
+    ):
+        self.backend = backend
+        self.interface = interface
+        self.window = window
+        self.max_batch = max_batch
+        self._pending = {}
+        self._timer = None
+        self._lock = None
+        self._tasks = set()
+
+    async def add(self, public_key, allowed_ip):
+        return await self._submit(public_key, allowed_ip)
+
+    async def remove(self, public_key):
+        return await self._submit(public_key, None)
+
+    async def _submit(self, public_key, allowed_ip):
+        future = asyncio.get_running_loop().create_future()
+        _, futures = self._pending.get(public_key, (None, []))
+        futures.append(future)
+        self._pending[public_key] = (allowed_ip, futures)
+
+        if len(self._pending) >= self.max_batch:
+            self._schedule(0)
+        elif self._timer is None:
+            self._schedule(self.window)
+        return await future
+
+    def _schedule(self, delay):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = asyncio.get_running_loop().call_later(delay, self._start_flush)
+
+    def _start_flush(self):
+        task = asyncio.ensure_future(self.flush())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    @property
+    def lock(self):
+        """
+        Блокировка применения батчей
+
+        Кто держит её, может работать с интерфейсом напрямую: пока она
+        занята, очередь ничего не применяет.
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    async def drain(self):
+        """Применить всё накопленное и дождаться запущенных батчей, при остановке бота"""
+        await self.flush()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def flush(self):
+        """Применить накопленные изменения одним батчем"""
+        async with self.lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            batch, self._pending = self._pending, {}
+            if not batch:
+                return
+
+            # Без результата хендлер ждал бы свой future вечно, держа очередь
+            # пользователя, поэтому при любой ошибке батч считается неудачным
+            results = dict.fromkeys(batch, False)
+            try:
+                results = await self._apply(batch)
+            except FileNotFoundError:
+                logger.warning("AmneziaWG не детектится")
+            except Exception as e:
+                logger.error(f"Ошибка применения батча из {len(batch)} пиров: {e}")
+            finally:
+                for public_key, (_, futures) in batch.items():
+                    for future in futures:
+                        if not future.done():
+                            future.set_result(results.get(public_key, False))
+
+    async def _apply(self, batch):
+        peers = [(public_key, allowed_ip) for public_key, (allowed_ip, _) in batch.items()]
+
+        # Пока применяется предыдущий батч, очередь может накопить больше
+        # max_batch ключей, а командная строка `awg set` не резиновая
+        results = {}
+        for start in range(0, len(peers), self.max_batch):
+            results.update(await self._set_chunk(peers[start : start + self.max_batch]))
+
+        if any(results.values()):
+            try:
+                await self.backend.save(self.interface)
+            except AwgError as e:
+                logger.error(f"Ошибка сохранения {self.interface}: {e}")
+                return dict.fromkeys(batch, False)
+
+        logger.info(f"Применено изменений пиров: {sum(results.values())}/{len(batch)}")
+        return results
+
+    async def _set_chunk(self, peers):
+        try:
+            await self.backend.set_peers(self.interface, peers)
+            return dict.fromkeys((public_key for public_key, _ in peers), True)
+        except AwgError as e:
+            # Один плохой пир валит весь вызов, повторяем по одному,
+            # чтобы каждый получил свой результат
+            logger.warning(f"Батч из {len(peers)} пиров не применился: {e}")
 
-        subprocess.run(cmd, capture_output=True, text=True, check=True)
-        logger.info(f"Удаляем peer {public_key[:8]}...")
+        results = {}
+        for public_key, allowed_ip in peers:
+            try:
+                await self.backend.set_peers(self.interface, [(public_key, allowed_ip)])
+                results[public_key] = True
+            except AwgError as e:
+                logger.error(f"Ошибка изменения пира {public_key[:8]}...: {e}")
+                results[public_key] = False
+        return results
 
-        subprocess.run(["awg-quick", "save", "wg0"], check=True)
 
-        return True
-    except subprocess.CalledProcessError as e:
-        logger.error(f"Ошибка с удалением peer: {e.stderr}")
+class Node:
+    """Сервер AmneziaWG (хост + интерфейс), на котором живут пиры"""
+
+    def __init__(
+        self,
+        name,
+        endpoint,
+        public_key,
+        subnet,
+        backend,
+        interface=WG_INTERFACE,
+        region=None,
+        capacity=None,
+        template_options=None,
+    ):
+        self.name = name
+        self.endpoint = endpoint
+        self.public_key = public_key
+        self.subnet = subnet
+        self.backend = backend
+        self.interface = interface
+        self.region = region
+        # Без явного ограничения — все адреса подсети, кроме сети, сервера и broadcast
+        self.capacity = capacity or ipaddress.ip_network(subnet).num_addresses - 3
+        self.queue = PeerQueue(backend, interface)
+        self.template = ConfigTemplate(public_key, endpoint, **(template_options or {}))
+
+    @classmethod
+    def from_spec(cls, spec):
+        """Создать узел из описания в WG_SERVERS"""
+        kind = spec.get("backend", "local")
+        if kind == "local":
+            backend = LocalAwgBackend()
+        elif kind == "ssh":
+            backend = SshAwgBackend(spec["host"])
+        elif kind == "fake":
+            backend = FakePeerBackend()
+        else:
+            raise ValueError(f"Неизвестный backend сервера {spec['name']}: {kind}")
+
+        template_options = {key: spec[key] for key in ("dns", "mtu", "obfuscation") if key in spec}
+        return cls(
+            name=spec["name"],
+            endpoint=spec["endpoint"],
+            public_key=spec["public_key"],
+            subnet=spec["subnet"],
+            backend=backend,
+            interface=spec.get("interface", WG_INTERFACE),
+            region=spec.get("region"),
+            capacity=spec.get("capacity"),
+            template_options=template_options,
+        )
+
+
+class NodeRegistry:
+    """Все серверы бота и стратегия размещения новых пиров"""
+
+    def __init__(self, nodes, placement):
+        self._nodes = {node.name: node for node in nodes}
+        self.placement = placement
+
+    def __iter__(self):
+        return iter(self._nodes.values())
+
+    def get(self, name):
+        """
+        Returns:
+            Node: None, если сервер убрали из WG_SERVERS, а конфиги на нём остались
+        """
+        return self._nodes.get(name)
+
+    def choose(self, loads, region=None, count=1):
+        """Выбрать сервер для count новых пиров по текущей загрузке {name: count}"""
+        return self.placement.choose(list(self), loads, region, count)
+
+
+nodes = NodeRegistry(
+    [Node.from_spec(spec) for spec in WG_SERVERS],
+    make_placement(PLACEMENT_STRATEGY, PLACEMENT_REGION),
+)
+
+
+async def add_peer_to_server(public_key, allowed_ip, server=DEFAULT_SERVER):
+    """
+    Добавить пира на AmneziaWG сервер
+    """
+    node = nodes.get(server)
+    if node is None:
+        logger.error(f"Сервер {server} не описан в WG_SERVERS, пир {public_key[:8]}... не добавлен")
         return False
-    except FileNotFoundError:
-        logger.warning("AmneziaWG не детектится")
+    success = await node.queue.add(public_key, allowed_ip)
+    if success:
+        logger.info(f"Добавлен пир {public_key[:8]}... с IP {allowed_ip}/32 на {server}")
+    return success
+
+
+async def remove_peer_from_server(public_key, server=DEFAULT_SERVER):
+    """
+    Удалить пира с AmneziaWG сервера
+    """
+    node = nodes.get(server)
+    if node is None:
+        logger.error(f"Сервер {server} не описан в WG_SERVERS, пир {public_key[:8]}... не удалён")
         return False
+    success = await node.queue.remove(public_key)
+    if success:
+        logger.info(f"Удаляем peer {public_key[:8]}... с {server}")
+    return success
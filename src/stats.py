@@ -0,0 +1,67 @@
+import asyncio
+import logging
+import time
+
+from config import (
+    STATS_BUCKET,
+    STATS_HOURLY_DAYS,
+    STATS_INTERVAL,
+    STATS_RETENTION_DAYS,
+)
+from server import AwgError
+
+logger = logging.getLogger(__name__)
+
+DAY = 86400
+
+
+class StatsCollector:
+    """
+    Фоновый сбор трафика и рукопожатий пиров
+
+    Раз в STATS_INTERVAL секунд читает `awg show <iface> dump` каждого
+    сервера одним вызовом и пишет приращения счётчиков в часовые бакеты.
+    Раз в час бакеты старше STATS_HOURLY_DAYS сворачиваются в дневные, а
+    дневные старше STATS_RETENTION_DAYS удаляются. Хендлеры читают только
+    базу и awg не вызывают.
+    """
+
+    def __init__(self, adb, nodes, interval=STATS_INTERVAL):
+        self.adb = adb
+        self.nodes = nodes
+        self.interval = interval
+        self._last_rollup = 0
+        self._task = None
+
+    async def collect(self):
+        now = int(time.time())
+        for node in self.nodes:
+            try:
+                live = await node.backend.dump(node.interface)
+            except (AwgError, FileNotFoundError) as e:
+                logger.error(f"Статистика {node.name} не собрана: {e}")
+                continue
+            matched = await self.adb.record_peer_stats(node.name, live, now, STATS_BUCKET)
+            logger.debug(f"Статистика {node.name}: {matched} пиров")
+
+        if now - self._last_rollup >= STATS_BUCKET:
+            self._last_rollup = now
+            await self.adb.rollup_traffic(
+                now - STATS_HOURLY_DAYS * DAY, now - STATS_RETENTION_DAYS * DAY
+            )
+
+    async def _run(self):
+        while True:
+            try:
+                await self.collect()
+            except Exception as e:
+                logger.error(f"Ошибка сбора статистики: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self.interval > 0:
+            self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
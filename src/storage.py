@@ -0,0 +1,97 @@
+import collections
+import json
+import time
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage
+
+from config import FSM_CACHE_SIZE, FSM_PURGE_INTERVAL, FSM_TTL
+
+
+def _key(key):
+    return (
+        f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id}:"
+        f"{key.business_connection_id}:{key.destiny}"
+    )
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    FSM хранилище в таблице fsm_states
+
+    Состояние переживает рестарт бота. Записи, не обновлявшиеся дольше
+    FSM_TTL, считаются пустыми и периодически удаляются, пустые записи
+    удаляются сразу. Последние FSM_CACHE_SIZE ключей, включая ключи без
+    записи, держатся в памяти, запись идёт и в кеш, и в базу.
+
+    Кеш принадлежит процессу и не сверяется с базой, поэтому хранилище
+    рассчитано на один процесс бота: второй процесс с той же базой
+    перезаписывал бы состояния первого, а тот продолжал бы читать свои из
+    кеша. При деплое это выполняется — старый экземпляр перестаёт принимать
+    апдейты до запуска нового, и новый начинает с пустым кешем.
+    """
+
+    def __init__(self, adb, ttl=FSM_TTL, cache_size=FSM_CACHE_SIZE):
+        self.adb = adb
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self._cache = collections.OrderedDict()
+        self._last_purge = time.time()
+
+    async def _load(self, key):
+        now = time.time()
+        record = self._cache.get(key)
+        if record is None:
+            row = await self.adb.get_fsm(key)
+            if row:
+                record = (row["state"], json.loads(row["data"]), row["updated_at"])
+            else:
+                # Отсутствие записи тоже кешируется, иначе каждый апдейт
+                # пользователя вне диалога стоил бы запроса к базе
+                record = (None, {}, now)
+            self._remember(key, record)
+        else:
+            self._cache.move_to_end(key)
+
+        if record is None or now - record[2] > self.ttl:
+            return None, {}
+        return record[0], record[1]
+
+    async def _save(self, key, state, data):
+        now = time.time()
+        self._remember(key, (state, data, now))
+        await self.adb.set_fsm(key, state, json.dumps(data, ensure_ascii=False), now)
+
+        if now - self._last_purge > FSM_PURGE_INTERVAL:
+            self._last_purge = now
+            await self.adb.purge_fsm(now - self.ttl)
+
+    def _remember(self, key, record):
+        if self.cache_size <= 0:
+            return
+        self._cache[key] = record
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def set_state(self, key, state=None):
+        key = _key(key)
+        _, data = await self._load(key)
+        state = state.state if isinstance(state, State) else state
+        await self._save(key, state, data)
+
+    async def get_state(self, key):
+        state, _ = await self._load(_key(key))
+        return state
+
+    async def set_data(self, key, data):
+        key = _key(key)
+        state, _ = await self._load(key)
+        await self._save(key, state, dict(data))
+
+    async def get_data(self, key):
+        _, data = await self._load(_key(key))
+        return dict(data)
+
+    async def close(self):
+        self._cache.clear()
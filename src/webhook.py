@@ -0,0 +1,98 @@
+import asyncio
+import logging
+
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+from config import (
+    WEBHOOK_HOST,
+    WEBHOOK_MAX_CONCURRENCY,
+    WEBHOOK_PATH,
+    WEBHOOK_PORT,
+    WEBHOOK_SECRET,
+    WEBHOOK_URL,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class LimitedRequestHandler(SimpleRequestHandler):
+    """
+    Обработчик вебхука с ограничением параллельности
+
+    Telegram получает ответ сразу, апдейт обрабатывается в фоне. Если уже
+    обрабатывается max_concurrency апдейтов, ответ откладывается до
+    освобождения слота: Telegram сам притормаживает доставку, а бот не копит
+    задачи в памяти.
+    """
+
+    def __init__(self, dispatcher, bot, max_concurrency, **kwargs):
+        super().__init__(dispatcher, bot, handle_in_background=True, **kwargs)
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def _handle_request_background(self, bot, request):
+        await self._semaphore.acquire()
+        try:
+            return await super()._handle_request_background(bot, request)
+        except BaseException:
+            self._semaphore.release()
+            raise
+
+    async def _background_feed_update(self, bot, update):
+        try:
+            await super()._background_feed_update(bot, update)
+        finally:
+            self._semaphore.release()
+
+    async def close(self):
+        """
+        Вызывается при остановке aiohttp приложения. Сессия бота ещё нужна
+        принятым апдейтам: main() закрывает её после Lifecycle.drain()
+        """
+
+
+def check_webhook_config():
+    """
+    Raises:
+        ValueError: не задан WEBHOOK_SECRET — без него любой, кто достучится
+            до порта, сможет прислать апдейт от имени ADMIN_ID
+    """
+    if not WEBHOOK_SECRET:
+        raise ValueError("Для BOT_MODE=webhook нужен WEBHOOK_SECRET")
+
+
+def build_app(dp, bot):
+    """aiohttp приложение, принимающее апдейты на WEBHOOK_PATH"""
+    app = web.Application()
+    handler = LimitedRequestHandler(dp, bot, WEBHOOK_MAX_CONCURRENCY, secret_token=WEBHOOK_SECRET)
+    handler.register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+async def run_webhook(dp, bot, stopping):
+    """
+    Принимать апдейты через вебхук, пока не выставлено событие stopping
+
+    При остановке сначала закрывается порт (Telegram повторит доставку
+    новому экземпляру), затем дожидаются уже принятые апдейты.
+    """
+    check_webhook_config()
+    runner = web.AppRunner(build_app(dp, bot))
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+    logger.info(f"Вебхук слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            max_connections=min(WEBHOOK_MAX_CONCURRENCY, 100),
+        )
+
+    try:
+        await stopping.wait()
+    finally:
+        logger.info("Останавливаем вебхук...")
+        await runner.cleanup()
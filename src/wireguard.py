@@ -1,7 +1,23 @@
+import asyncio
 import base64
+import collections
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
 from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
 from cryptography.hazmat.primitives import serialization
 
+from config import (
+    AWG_OBFUSCATION,
+    CLIENT_ALLOWED_IPS,
+    CLIENT_DNS,
+    CLIENT_KEEPALIVE,
+    CLIENT_MTU,
+    CONFIG_CACHE_SIZE,
+    KEY_POOL_HIGH,
+    KEY_POOL_LOW,
+)
+
 
 def generate_keys():
     """
@@ -28,6 +44,171 @@ def generate_keys():
     return private_key, public_key
 
 
+def generate_keys_bulk(n):
+    """
+    Сгенерировать сразу n пар ключей (для массового создания конфигов)
+
+    Returns:
+        list: [(private_key, public_key), ...]
+    """
+    return [generate_keys() for _ in range(n)]
+
+
+class KeyPool:
+    """
+    Пул заранее сгенерированных пар ключей
+
+    Когда в пуле остаётся меньше low_water пар, фоновый поток догенерирует
+    его до high_water. Создание конфига забирает готовую пару за O(1). Если
+    пул пуст, пара считается сразу, но тоже в потоке генерации ключей, а не
+    в event loop: запрос ждёт её вместе с очередью догенерации.
+    """
+
+    REFILL_CHUNK = 32
+
+    def __init__(self, low_water=KEY_POOL_LOW, high_water=KEY_POOL_HIGH):
+        self.low_water = low_water
+        self.high_water = high_water
+        self._keys = collections.deque()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="keygen")
+        self._refill_task = None
+
+    def __len__(self):
+        return len(self._keys)
+
+    def start(self):
+        """Заполнить пул в фоне, вызывать из работающего event loop"""
+        self._maybe_refill()
+
+    async def get(self):
+        """Забрать одну пару ключей"""
+        try:
+            pair = self._keys.popleft()
+        except IndexError:
+            loop = asyncio.get_running_loop()
+            pair = await loop.run_in_executor(self._executor, generate_keys)
+        self._maybe_refill()
+        return pair
+
+    async def get_many(self, n):
+        """Забрать n пар ключей, недостающие догенерировать в фоновом потоке"""
+        pairs = []
+        while self._keys and len(pairs) < n:
+            pairs.append(self._keys.popleft())
+        if len(pairs) < n:
+            loop = asyncio.get_running_loop()
+            pairs += await loop.run_in_executor(self._executor, generate_keys_bulk, n - len(pairs))
+        self._maybe_refill()
+        return pairs
+
+    def _maybe_refill(self):
+        if len(self._keys) < self.low_water and self._refill_task is None:
+            self._refill_task = asyncio.ensure_future(self._refill())
+
+    async def _refill(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while len(self._keys) < self.high_water:
+                n = min(self.REFILL_CHUNK, self.high_water - len(self._keys))
+                self._keys.extend(await loop.run_in_executor(self._executor, generate_keys_bulk, n))
+        finally:
+            self._refill_task = None
+
+    def close(self):
+        if self._refill_task is not None:
+            self._refill_task.cancel()
+        self._executor.shutdown(wait=False)
+        self._keys.clear()
+
+
+key_pool = KeyPool()
+
+
+class ConfigTemplate:
+    """
+    Скомпилированный шаблон клиентского конфига для одного сервера
+
+    Всё, что не зависит от пира (DNS, MTU, параметры обфускации, ключ и
+    адрес сервера), рендерится и кодируется один раз при создании шаблона.
+    На каждый конфиг подставляются только PrivateKey и Address.
+    """
+
+    def __init__(
+        self,
+        server_public_key,
+        server_endpoint,
+        dns=CLIENT_DNS,
+        mtu=CLIENT_MTU,
+        obfuscation=None,
+        allowed_ips=CLIENT_ALLOWED_IPS,
+        keepalive=CLIENT_KEEPALIVE,
+    ):
+        obfuscation = AWG_OBFUSCATION if obfuscation is None else obfuscation
+        obfuscation_lines = "".join(f"{key} = {value}\n" for key, value in obfuscation.items())
+
+        self._head = b"[Interface]\nPrivateKey = "
+        self._middle = b"\nAddress = "
+        self._tail = (
+            f"/32\n"
+            f"DNS = {dns}\n"
+            f"MTU = {mtu}\n"
+            f"{obfuscation_lines}"
+            f"\n"
+            f"[Peer]\n"
+            f"PublicKey = {server_public_key}\n"
+            f"Endpoint = {server_endpoint}\n"
+            f"AllowedIPs = {allowed_ips}\n"
+            f"PersistentKeepalive = {keepalive}\n"
+        ).encode("utf-8")
+        # Меняется вместе с любым параметром сервера: по нему сбрасываются
+        # загруженные в Telegram файлы конфигов
+        self.fingerprint = hashlib.sha256(self._tail).hexdigest()[:16]
+
+    def render(self, private_key, client_ip):
+        """
+        Returns:
+            bytes: Конфигурация в формате AmneziaWG
+        """
+        return b"".join(
+            (
+                self._head,
+                private_key.encode("ascii"),
+                self._middle,
+                client_ip.encode("ascii"),
+                self._tail,
+            )
+        )
+
+
+class ConfigCache:
+    """LRU кеш готовых .conf по id конфига"""
+
+    def __init__(self, max_size=CONFIG_CACHE_SIZE):
+        self.max_size = max_size
+        self._items = collections.OrderedDict()
+
+    def get(self, config_id):
+        data = self._items.get(config_id)
+        if data is not None:
+            self._items.move_to_end(config_id)
+        return data
+
+    def put(self, config_id, data):
+        self._items[config_id] = data
+        self._items.move_to_end(config_id)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def invalidate(self, config_id):
+        self._items.pop(config_id, None)
+
+    def clear(self):
+        self._items.clear()
+
+
+config_cache = ConfigCache()
+
+
 def create_client_config(private_key, server_public_key, server_endpoint, client_ip):
     """
     Создание конфигурации клиента для AmneziaWG
@@ -41,28 +222,8 @@ def create_client_config(private_key, server_public_key, server_endpoint, client
     Returns:
         str: Конфигурация в формате AmneziaWG
     """
-    config = f"""[Interface]
-PrivateKey = {private_key}
-Address = {client_ip}/32
-DNS = 1.1.1.1, 8.8.8.8
-MTU = 1280
-Jc = 5
-Jmin = 50
-Jmax = 1000
-S1 = 86
-S2 = 123
-H1 = 1234567
-H2 = 2345678
-H3 = 3456789
-H4 = 4567890
-
-[Peer]
-PublicKey = {server_public_key}
-Endpoint = {server_endpoint}
-AllowedIPs = 0.0.0.0/0, ::/0
-PersistentKeepalive = 10
-"""
-    return config
+    template = ConfigTemplate(server_public_key, server_endpoint)
+    return template.render(private_key, client_ip).decode("utf-8")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,12 @@
+import os
+import sys
+import tempfile
+
+# Модули бота импортируются верхнего уровня, как при запуске src/main.py
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+
+def pytest_sessionstart(session):
+    # database при импорте открывает data/bot.db относительно текущего
+    # каталога, тесты не должны трогать базу из рабочей копии
+    os.chdir(tempfile.mkdtemp(prefix="tg-bot-vpn-test-"))
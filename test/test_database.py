@@ -0,0 +1,163 @@
+import pytest
+
+from database import DEFAULT_CONFIG_QUOTA, MIGRATIONS, Database, IpPoolExhausted, QuotaExceeded
+
+
+def make_db(tmp_path):
+    return Database(
+        str(tmp_path / "bot.db"), ip_pools={"default": "10.0.0.0/24", "second": "10.1.0.0/24"}
+    )
+
+
+def create(db, name, server="default"):
+    return db.create_vpn_config(1, name, "priv", f"pub-{name}", server, enforce_quota=False)
+
+
+def counted_loads(db):
+    with db.get_connection() as conn:
+        rows = conn.execute("SELECT server, COUNT(*) FROM vpn_configs GROUP BY server")
+        return dict(rows.fetchall())
+
+
+def test_deleted_ip_is_reused(tmp_path):
+    db = make_db(tmp_path)
+    db.add_user(1)
+    first, second = create(db, "a"), create(db, "b")
+    assert [first["ip_address"], second["ip_address"]] == ["10.0.0.2", "10.0.0.3"]
+
+    db.delete_vpn_config(1, "a")
+    assert create(db, "c")["ip_address"] == "10.0.0.2"
+    assert create(db, "d")["ip_address"] == "10.0.0.4"
+    db.close()
+
+
+def test_pool_exhausted_at_subnet_boundary(tmp_path):
+    db = Database(str(tmp_path / "bot.db"), ip_pools={"default": "10.0.0.0/29"})
+    db.add_user(1)
+    # .0 — сеть, .1 — сервер, .7 — broadcast
+    assert [create(db, f"c{n}")["ip_address"] for n in range(5)] == [
+        f"10.0.0.{host}" for host in range(2, 7)
+    ]
+    with pytest.raises(IpPoolExhausted):
+        create(db, "extra")
+    db.close()
+
+
+def test_subnet_expands_on_restart(tmp_path):
+    db = Database(str(tmp_path / "bot.db"), ip_pools={"default": "10.0.0.0/29"})
+    db.add_user(1)
+    for n in range(5):
+        create(db, f"c{n}")
+    db.close()
+
+    db = Database(str(tmp_path / "bot.db"), ip_pools={"default": "10.0.0.0/28"})
+    assert create(db, "extra")["ip_address"] == "10.0.0.7"
+    db.close()
+
+    with pytest.raises(ValueError):
+        Database(str(tmp_path / "bot.db"), ip_pools={"default": "10.0.1.0/24"})
+
+
+def test_explicit_ip_is_reserved(tmp_path):
+    db = make_db(tmp_path)
+    db.add_user(1)
+    db.add_vpn_config(1, "manual", "priv", "pub-manual", "10.0.0.4")
+
+    # адреса до выбранного вручную остаются свободными, сам он не выдаётся
+    assert [create(db, f"c{n}")["ip_address"] for n in range(3)] == [
+        "10.0.0.2",
+        "10.0.0.3",
+        "10.0.0.5",
+    ]
+    db.close()
+
+
+def test_quota_limits_configs(tmp_path):
+    db = make_db(tmp_path)
+    db.add_user(1)
+    db.set_user_quota(1, quota=2)
+    db.create_vpn_config(1, "a", "priv", "pub-a")
+    db.create_vpn_config(1, "b", "priv", "pub-b")
+    with pytest.raises(QuotaExceeded):
+        db.create_vpn_config(1, "c", "priv", "pub-c")
+
+    # админские конфиги создаются в обход квоты
+    db.create_vpn_config(1, "c", "priv", "pub-c", enforce_quota=False)
+    assert db.get_quota_usage(1) == (3, 2)
+    db.close()
+
+
+def test_quota_from_tier_and_reset(tmp_path):
+    db = make_db(tmp_path)
+    db.add_user(1)
+    assert db.get_quota_usage(1) == (0, DEFAULT_CONFIG_QUOTA)
+
+    db.set_quota_tier("vip", 20)
+    db.set_user_quota(1, quota=3)
+    # тариф заменяет личную квоту, а не прячется за ней
+    db.set_user_quota(1, tier="vip")
+    assert db.get_quota_usage(1) == (0, 20)
+    db.set_quota_tier("vip", 30)
+    assert db.get_quota_usage(1) == (0, 30)
+
+    db.set_user_quota(1)
+    assert db.get_quota_usage(1) == (0, DEFAULT_CONFIG_QUOTA)
+    with pytest.raises(ValueError):
+        db.set_user_quota(1, tier="missing")
+    assert db.set_user_quota(2, quota=1) is False
+    db.close()
+
+
+def test_server_loads_follow_configs(tmp_path):
+    db = make_db(tmp_path)
+    db.add_user(1)
+    first = db.create_vpn_config(1, "a", "priv", "pub-a")
+    db.create_vpn_configs(1, [("b", "priv", "pub-b"), ("c", "priv", "pub-c")], server="second")
+    db.add_vpn_config(1, "d", "priv", "pub-d", "10.0.0.50")
+    db.delete_vpn_config_by_id(first["id"], 1)
+    db.delete_vpn_config(1, "b")
+
+    loads = {server: count for server, count in db.get_server_loads().items() if count}
+    assert loads == counted_loads(db) == {"default": 1, "second": 1}
+    db.close()
+
+
+def test_server_loads_migration_counts_existing_configs(tmp_path):
+    db = make_db(tmp_path)
+    db.add_user(1)
+    db.create_vpn_configs(1, [("a", "priv", "pub-a"), ("b", "priv", "pub-b")])
+    with db.get_connection() as conn:
+        conn.execute("DROP TABLE server_loads")
+        conn.execute(f"PRAGMA user_version = {len(MIGRATIONS) - 1}")
+    db.close()
+
+    db = make_db(tmp_path)
+    assert db.get_server_loads() == {"default": 2}
+    db.close()
+
+
+def test_peer_traffic_starts_from_first_snapshot(tmp_path):
+    db = make_db(tmp_path)
+    db.add_user(1)
+    config = db.create_vpn_config(1, "a", "priv", "pub-a")
+    hour = 3600
+
+    def snapshot(now, rx, tx):
+        peer = {"latest_handshake": now, "rx": rx, "tx": tx}
+        db.record_peer_stats("default", {"pub-a": peer}, now, hour)
+
+    # счётчики за всё время жизни интерфейса — только точка отсчёта
+    snapshot(10 * hour, 5_000_000, 7_000_000)
+    snapshot(10 * hour + 60, 5_000_100, 7_000_200)
+    # интерфейс перезапустили, счётчики начались с нуля
+    snapshot(11 * hour, 30, 40)
+
+    with db.get_connection() as conn:
+        traffic = conn.execute(
+            "SELECT bucket, rx, tx FROM peer_traffic WHERE config_id = ? ORDER BY bucket",
+            (config["id"],),
+        ).fetchall()
+    assert [tuple(row) for row in traffic] == [(10 * hour, 100, 200), (11 * hour, 30, 40)]
+    stats = db.get_peer_stats(1)[config["id"]]
+    assert (stats["rx_total"], stats["tx_total"]) == (130, 240)
+    db.close()
@@ -0,0 +1,58 @@
+import asyncio
+import time
+
+from database import AsyncDatabase, Database
+from evict import IdleEvictor
+from server import FakePeerBackend, Node
+
+DAY = 86400
+
+
+def make_node(tmp_path):
+    db = Database(str(tmp_path / "bot.db"), ip_pools={"default": "10.0.0.0/24"})
+    node = Node("default", "127.0.0.1:51820", "server-key", "10.0.0.0/24", FakePeerBackend())
+    return db, AsyncDatabase(db), node
+
+
+def add_old_peer(db, node, public_key, age_days):
+    db.add_user(1)
+    config = db.create_vpn_config(1, public_key, "priv", public_key, enforce_quota=False)
+    with db.get_connection() as conn:
+        conn.execute(
+            "UPDATE vpn_configs SET created_at = datetime(?, 'unixepoch') WHERE id = ?",
+            (int(time.time()) - age_days * DAY, config["id"]),
+        )
+    node.backend.interfaces.setdefault(node.interface, {})[public_key] = {
+        "allowed_ips": f"{config['ip_address']}/32",
+        "latest_handshake": 0,
+        "rx": 0,
+        "tx": 0,
+    }
+    return config
+
+
+def test_reboot_does_not_evict_recent_peers(tmp_path):
+    db, adb, node = make_node(tmp_path)
+    recent = add_old_peer(db, node, "recent", 60)
+    add_old_peer(db, node, "never", 60)
+    now = int(time.time())
+
+    peers = node.backend.interfaces[node.interface]
+    peers["recent"]["latest_handshake"] = now - DAY
+    db.record_peer_stats("default", {key: dict(peer) for key, peer in peers.items()}, now, 3600)
+
+    # перезагрузка хоста: рукопожатия обнулились
+    peers["recent"]["latest_handshake"] = 0
+    db.record_peer_stats("default", {key: dict(peer) for key, peer in peers.items()}, now, 3600)
+    assert db.get_peer_stats(1)[recent["id"]]["last_handshake"] == now - DAY
+
+    evictor = IdleEvictor(adb, [node], idle_days=30)
+
+    async def scenario():
+        evicted = await evictor.evict_node(node)
+        await node.queue.drain()
+        return evicted
+
+    assert asyncio.run(scenario()) == 1
+    assert set(node.backend.interfaces[node.interface]) == {"recent"}
+    db.close()
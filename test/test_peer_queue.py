@@ -0,0 +1,107 @@
+import asyncio
+
+from server import AwgError, FakePeerBackend, PeerQueue
+
+
+class BrokenBackend(FakePeerBackend):
+    """Бэкенд, у которого awg падает не с AwgError"""
+
+    def __init__(self, error):
+        super().__init__()
+        self.error = error
+
+    async def set_peers(self, interface, peers):
+        raise self.error
+
+
+class BadPeerBackend(FakePeerBackend):
+    """Батч с ключом bad не применяется, по одному — остальные применяются"""
+
+    async def set_peers(self, interface, peers):
+        if any(public_key == "bad" for public_key, _ in peers):
+            raise AwgError("bad peer")
+        await super().set_peers(interface, peers)
+
+
+def run(coro):
+    return asyncio.run(asyncio.wait_for(coro, 2))
+
+
+def test_batch_applies_all_peers():
+    backend = FakePeerBackend()
+    queue = PeerQueue(backend, "wg0", window=0.01)
+
+    async def scenario():
+        return await asyncio.gather(queue.add("a", "10.0.0.2"), queue.add("b", "10.0.0.3"))
+
+    assert run(scenario()) == [True, True]
+    assert set(backend.interfaces["wg0"]) == {"a", "b"}
+    assert backend.saves == 1
+
+
+def test_bad_peer_fails_alone():
+    queue = PeerQueue(BadPeerBackend(), "wg0", window=0.01)
+
+    async def scenario():
+        return await asyncio.gather(queue.add("good", "10.0.0.2"), queue.add("bad", "10.0.0.3"))
+
+    assert run(scenario()) == [True, False]
+
+
+def test_unexpected_backend_error_fails_batch():
+    queue = PeerQueue(BrokenBackend(PermissionError("denied")), "wg0", window=0.01)
+
+    async def scenario():
+        results = await asyncio.gather(queue.add("a", "10.0.0.2"), queue.remove("b"))
+        # очередь после ошибки продолжает работать
+        queue.backend = FakePeerBackend()
+        results.append(await queue.add("c", "10.0.0.4"))
+        return results
+
+    assert run(scenario()) == [False, False, True]
+
+
+def test_drain_applies_pending():
+    backend = FakePeerBackend()
+    queue = PeerQueue(backend, "wg0", window=60)
+
+    async def scenario():
+        task = asyncio.ensure_future(queue.add("a", "10.0.0.2"))
+        await asyncio.sleep(0)
+        await queue.drain()
+        return await task
+
+    assert run(scenario()) is True
+    assert "a" in backend.interfaces["wg0"]
+
+
+class RecordingBackend(FakePeerBackend):
+    """Запоминает размер каждого вызова set_peers"""
+
+    def __init__(self):
+        super().__init__()
+        self.calls = []
+
+    async def set_peers(self, interface, peers):
+        self.calls.append(len(peers))
+        await super().set_peers(interface, peers)
+
+
+def test_large_batch_is_split_by_max_batch():
+    backend = RecordingBackend()
+    queue = PeerQueue(backend, "wg0", window=60, max_batch=200)
+
+    async def scenario():
+        # Пока очередь занята, изменения копятся сверх max_batch
+        async with queue.lock:
+            tasks = [
+                asyncio.ensure_future(queue.add(f"key{n}", f"10.0.{n // 250}.{n % 250 + 2}"))
+                for n in range(1000)
+            ]
+            await asyncio.sleep(0.01)
+        return await asyncio.gather(*tasks)
+
+    assert all(run(scenario()))
+    assert backend.calls == [200] * 5
+    assert len(backend.interfaces["wg0"]) == 1000
+    assert backend.saves == 1
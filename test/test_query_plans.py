@@ -0,0 +1,126 @@
+"""
+Планы горячих запросов Database на большой базе
+
+Заполняет временную базу ROWS конфигами, вызывает горячие методы Database,
+перехватывает выполненный SQL и прогоняет его через EXPLAIN QUERY PLAN.
+Тест падает, если запрос читает таблицу целиком (SCAN, в том числе полный
+проход по индексу) или сортирует через временное B-дерево. Читать целиком
+можно только таблицы, размер которых не зависит от числа пользователей.
+"""
+
+import sqlite3
+import time
+
+from database import Database
+
+ROWS = 20000
+
+# Таблицы по строке на сервер
+SMALL_TABLES = {"server_loads"}
+
+
+class TracedDatabase(Database):
+    def __init__(self, *args, **kwargs):
+        self.statements = []
+        super().__init__(*args, **kwargs)
+
+    def _connect(self):
+        conn = super()._connect()
+        conn.set_trace_callback(self.statements.append)
+        return conn
+
+
+def fill(db, rows):
+    users = rows // 5
+    with db.get_connection() as conn:
+        conn.executemany(
+            "INSERT INTO users (user_id, username, first_name) VALUES (?, ?, ?)",
+            ((user_id, f"user{user_id}", "bench") for user_id in range(users)),
+        )
+        conn.executemany(
+            """
+            INSERT INTO vpn_configs (user_id, name, private_key, public_key, ip_address)
+            VALUES (?, ?, ?, ?, ?)
+        """,
+            (
+                (
+                    i % users,
+                    f"cfg{i // users}",
+                    "priv",
+                    f"pub{i}",
+                    f"11.{i >> 16}.{i >> 8 & 255}.{i & 255}",
+                )
+                for i in range(rows)
+            ),
+        )
+        conn.executemany(
+            "INSERT INTO fsm_states (key, state, data, updated_at) VALUES (?, ?, ?, ?)",
+            ((f"1:{i}:{i}:None:None:default", None, "{}", time.time()) for i in range(users)),
+        )
+
+
+def exercise(db, rows):
+    """Вызовы, которые бот делает на каждое нажатие кнопки"""
+    user_id = rows // 10
+    db.get_user(user_id)
+    db.list_vpn_configs(user_id)
+    db.get_all_vpn_configs(user_id)
+    db.get_vpn_config(user_id, "cfg1")
+    db.get_vpn_config_by_id(rows // 2, user_id)
+    db.get_vpn_config_by_public_key(f"pub{rows // 3}")
+    db.get_server_loads()
+    db.set_user_quota(user_id, quota=100)
+    db.get_quota_usage(user_id)
+    created = db.create_vpn_config(user_id, "new", "priv", "pubnew")
+    db.delete_vpn_config_by_id(created["id"], user_id)
+    now = int(time.time())
+    db.record_peer_stats(
+        "default", {f"pub{rows // 3}": {"latest_handshake": now, "rx": 10, "tx": 20}}, now, 3600
+    )
+    db.deactivate_idle_peers("default", [f"pub{rows // 3}"], now)
+    db.activate_vpn_config(rows // 3)
+    db.get_peer_stats(user_id)
+    db.get_traffic_summary(now - 86400, now - 180)
+    db.rollup_traffic(now - 7 * 86400, now - 90 * 86400)
+    broadcast_id = db.create_broadcast("text")
+    db.iter_active_user_ids(user_id, 200)
+    db.deactivate_users([user_id])
+    db.save_broadcast_progress(broadcast_id, user_id, 1, 0, 1)
+    db.get_running_broadcasts()
+    db.finish_broadcast(broadcast_id)
+    db.get_fsm(f"1:{user_id}:{user_id}:None:None:default")
+    db.set_fsm(f"1:{user_id}:{user_id}:None:None:default", "S:a", "{}", time.time())
+    db.purge_fsm(time.time() - 3600)
+
+
+def explain(db_path, sql):
+    conn = sqlite3.connect(db_path)
+    try:
+        return [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}")]
+    finally:
+        conn.close()
+
+
+def test_hot_queries_use_indexes(tmp_path):
+    db_path = str(tmp_path / "plans.db")
+    db = TracedDatabase(db_path, ip_pools={"default": "10.0.0.0/8"})
+    fill(db, ROWS)
+    db.statements.clear()
+    exercise(db, ROWS)
+    db.close()
+
+    failures = {}
+    for sql in dict.fromkeys(" ".join(sql.split()) for sql in db.statements):
+        if not sql.upper().startswith(("SELECT", "UPDATE", "DELETE")):
+            continue
+        plan = explain(db_path, sql)
+        bad = [
+            step
+            for step in plan
+            if step.startswith("SCAN")
+            and step.split()[1] not in SMALL_TABLES
+            or "TEMP B-TREE" in step
+        ]
+        if bad:
+            failures[sql] = plan
+    assert not failures, "запросы без индекса"
@@ -0,0 +1,50 @@
+import asyncio
+import sqlite3
+
+from reconcile import Reconciler
+from server import FakePeerBackend, Node
+
+
+class LockedDatabase:
+    """База, которая первый раз отвечает database is locked"""
+
+    def __init__(self, peers):
+        self.peers = peers
+        self.calls = 0
+
+    async def get_server_loads(self):
+        return {"default": len(self.peers)}
+
+    async def get_server_peers(self, server):
+        self.calls += 1
+        if self.calls == 1:
+            raise sqlite3.OperationalError("database is locked")
+        return dict(self.peers)
+
+
+def make_node(name):
+    return Node(name, "127.0.0.1:51820", "server-key", "10.0.0.0/24", FakePeerBackend())
+
+
+def test_unexpected_error_skips_node():
+    adb = LockedDatabase({"a": "10.0.0.2"})
+    first, second = make_node("first"), make_node("second")
+    results = asyncio.run(Reconciler(adb, [first, second]).reconcile())
+
+    assert results == {"second": {"added": 1, "removed": 0}}
+    assert "a" in second.backend.interfaces["wg0"]
+
+
+def test_periodic_run_survives_errors():
+    adb = LockedDatabase({"a": "10.0.0.2"})
+    node = make_node("default")
+    reconciler = Reconciler(adb, [node], interval=0.01)
+
+    async def scenario():
+        reconciler.start()
+        await asyncio.sleep(0.1)
+        reconciler.stop()
+
+    asyncio.run(scenario())
+    assert adb.calls > 1
+    assert "a" in node.backend.interfaces["wg0"]
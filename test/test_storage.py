@@ -0,0 +1,67 @@
+import asyncio
+
+from aiogram.fsm.storage.base import StorageKey
+
+from storage import SQLiteStorage
+
+
+class FakeFsmDatabase:
+    """Таблица fsm_states в словаре, со счётчиком чтений"""
+
+    def __init__(self):
+        self.rows = {}
+        self.reads = 0
+
+    async def get_fsm(self, key):
+        self.reads += 1
+        return self.rows.get(key)
+
+    async def set_fsm(self, key, state, data, updated_at):
+        if state is None and data == "{}":
+            self.rows.pop(key, None)
+        else:
+            self.rows[key] = {"state": state, "data": data, "updated_at": updated_at}
+
+    async def purge_fsm(self, before):
+        pass
+
+
+KEY = StorageKey(bot_id=1, chat_id=5, user_id=5)
+
+
+def test_missing_state_read_once():
+    adb = FakeFsmDatabase()
+    storage = SQLiteStorage(adb)
+
+    async def scenario():
+        for _ in range(100):
+            assert await storage.get_state(KEY) is None
+
+    asyncio.run(scenario())
+    assert adb.reads == 1
+
+
+def test_state_survives_restart():
+    adb = FakeFsmDatabase()
+
+    async def scenario():
+        await SQLiteStorage(adb).set_state(KEY, "VpnCreation:waiting_for_name")
+        restarted = SQLiteStorage(adb)
+        return await restarted.get_state(KEY)
+
+    assert asyncio.run(scenario()) == "VpnCreation:waiting_for_name"
+
+
+def test_cleared_state_after_cached_miss():
+    adb = FakeFsmDatabase()
+    storage = SQLiteStorage(adb)
+
+    async def scenario():
+        await storage.get_state(KEY)
+        await storage.set_state(KEY, "VpnCreation:waiting_for_name")
+        assert await storage.get_state(KEY) == "VpnCreation:waiting_for_name"
+        await storage.set_state(KEY, None)
+        return await storage.get_state(KEY)
+
+    assert asyncio.run(scenario()) is None
+    assert adb.rows == {}